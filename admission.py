@@ -0,0 +1,139 @@
+"""Admission control: bounded queue of inference tasks with per-user fairness."""
+
+from __future__ import annotations
+from typing import Dict, Any, Callable, Optional, Tuple
+from collections import OrderedDict, deque
+import math
+import threading
+import time
+
+
+class QueueFull(Exception):
+    """Очередь переполнена: запрос не принят, повторить через retry_after секунд."""
+
+    def __init__(self, retry_after: int, reason: str) -> None:
+        super().__init__(reason)
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class AdmissionController:
+    """
+    Пул из workers потоков перед моделью.
+
+    Очередь ограничена max_queue задачами (и max_user_queued на пользователя),
+    лишние запросы сразу отклоняются QueueFull. Свободный поток берёт задачи
+    пользователей по кругу, и у одного пользователя одновременно выполняется
+    не больше per_user_limit задач — тот, кто шлёт много запросов, ждёт сам,
+    а не замедляет остальных.
+    """
+
+    def __init__(self, workers: int, max_queue: int, per_user_limit: int, max_user_queued: int,
+                 name: str = "cosmocat-admission") -> None:
+        self.workers = max(1, workers)
+        self.max_queue = max_queue
+        self.per_user_limit = max(1, per_user_limit)
+        self.max_user_queued = max_user_queued
+        self._name = name
+        self._cond = threading.Condition()
+        # user_id -> очередь (время постановки, функция, аргументы); порядок ключей — очередь обхода
+        self._queues: "OrderedDict[Any, deque]" = OrderedDict()
+        self._queued = 0
+        self._running: Dict[Any, int] = {}
+        self._threads = []
+        # Статистика
+        self._admitted = 0
+        self._rejected = 0
+        self._waits: deque = deque(maxlen=512)
+        self._service: deque = deque(maxlen=512)
+
+    def _ensure_threads(self) -> None:
+        # Потоки стартуют лениво, при первой задаче
+        if not self._threads:
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._loop, name=f"{self._name}-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _retry_after(self) -> int:
+        """Оценка, через сколько секунд в очереди освободится место"""
+        service = sum(self._service) / len(self._service) if self._service else 5.0
+        return max(1, math.ceil(service * max(1, self._queued) / self.workers))
+
+    def submit(self, user_id: Any, fn: Callable[..., Any], *args: Any) -> None:
+        """Ставит fn(*args) в очередь пользователя или бросает QueueFull."""
+        with self._cond:
+            user_queue = self._queues.get(user_id)
+            if self._queued >= self.max_queue:
+                self._rejected += 1
+                raise QueueFull(self._retry_after(), "очередь генерации заполнена")
+            if user_queue is not None and len(user_queue) >= self.max_user_queued:
+                self._rejected += 1
+                raise QueueFull(self._retry_after(), "слишком много запросов от пользователя")
+            if user_queue is None:
+                user_queue = self._queues[user_id] = deque()
+            user_queue.append((time.monotonic(), fn, args))
+            self._queued += 1
+            self._admitted += 1
+            self._ensure_threads()
+            self._cond.notify()
+
+    def _take(self) -> Optional[Tuple[Any, float, Callable[..., Any], tuple]]:
+        """Следующая задача по кругу среди пользователей, не упёршихся в свой лимит"""
+        for user_id in list(self._queues):
+            if self._running.get(user_id, 0) >= self.per_user_limit:
+                continue
+            user_queue = self._queues.pop(user_id)
+            enqueued_at, fn, args = user_queue.popleft()
+            if user_queue:
+                # Пользователь уходит в конец круга
+                self._queues[user_id] = user_queue
+            self._queued -= 1
+            self._running[user_id] = self._running.get(user_id, 0) + 1
+            return user_id, enqueued_at, fn, args
+        return None
+
+    def _loop(self) -> None:
+        while True:
+            with self._cond:
+                task = self._take()
+                while task is None:
+                    self._cond.wait()
+                    task = self._take()
+            user_id, enqueued_at, fn, args = task
+            started = time.monotonic()
+            try:
+                fn(*args)
+            except Exception as e:
+                print(f"❌ Ошибка задачи генерации: {e}")
+            finally:
+                with self._cond:
+                    self._waits.append(started - enqueued_at)
+                    self._service.append(time.monotonic() - started)
+                    self._running[user_id] -= 1
+                    if not self._running[user_id]:
+                        del self._running[user_id]
+                    # Освободился слот пользователя — его задачи снова доступны
+                    self._cond.notify_all()
+
+    def queue_depth(self) -> int:
+        with self._cond:
+            return self._queued
+
+    def stats(self) -> Dict[str, Any]:
+        """Глубина очереди, занятость и время ожидания в очереди"""
+        with self._cond:
+            waits = sorted(self._waits)
+            return {
+                "workers": self.workers,
+                "max_queue": self.max_queue,
+                "per_user_limit": self.per_user_limit,
+                "queue_depth": self._queued,
+                "queued_users": len(self._queues),
+                "running": sum(self._running.values()),
+                "admitted": self._admitted,
+                "rejected": self._rejected,
+                "wait_avg_ms": round(1000 * sum(waits) / len(waits), 1) if waits else None,
+                "wait_p95_ms": round(1000 * waits[min(len(waits) - 1, int(0.95 * len(waits)))], 1) if waits else None,
+                "retry_after": self._retry_after(),
+            }
@@ -1,29 +1,111 @@
 """AI core: CPU-only small Russian-capable model with graceful fallback."""
 
 from __future__ import annotations
-from typing import List, Dict, Optional
+from typing import TYPE_CHECKING, List, Dict, Optional, Iterator, Any, Callable
 import os
-import requests
 import threading
 import random
 import re
+import time
+import copy
+import gc
+from collections import OrderedDict
+
+from inference_scheduler import InferenceScheduler, GenerationRequest
+from model_lifecycle import ModelLifecycle, dir_size_mb, rss_mb
+from reply_cache import ReplyCache
+
+if TYPE_CHECKING:
+    from transformers import PreTrainedModel, PreTrainedTokenizerBase
+
+# torch и transformers импортируются лениво, при первой загрузке модели (_import_ml):
+# веб-процессу, который отдаёт страницы и аватарки, они не нужны.
+# None — импорт ещё не пробовали, True/False — результат попытки.
+TRANSFORMERS_AVAILABLE: Optional[bool] = None
+torch = None
+AutoConfig = None
+AutoTokenizer = None
+AutoModelForCausalLM = None
+TextIteratorStreamer = None
+StoppingCriteriaList = None
+DynamicCache = None
+Conv1D = None
+
+# Опциональный ONNX Runtime бэкенд (через optimum), тоже лениво
+ONNX_AVAILABLE: Optional[bool] = None
+onnxruntime = None
+ORTModelForCausalLM = None
+
+_import_lock = threading.Lock()
+
+
+def _import_ml() -> bool:
+    """Импортирует torch и transformers при первом вызове. Возвращает, доступны ли они."""
+    global TRANSFORMERS_AVAILABLE, torch, AutoConfig, AutoTokenizer, AutoModelForCausalLM
+    global TextIteratorStreamer, StoppingCriteriaList, DynamicCache, Conv1D
+    if TRANSFORMERS_AVAILABLE is not None:
+        return TRANSFORMERS_AVAILABLE
+    with _import_lock:
+        if TRANSFORMERS_AVAILABLE is None:
+            try:
+                import torch
+                from transformers import AutoConfig, AutoTokenizer, AutoModelForCausalLM, TextIteratorStreamer, StoppingCriteriaList, DynamicCache
+                from transformers.pytorch_utils import Conv1D
+                TRANSFORMERS_AVAILABLE = True
+            except ImportError as e:
+                print(f"⚠️ Transformers not available: {e}")
+                TRANSFORMERS_AVAILABLE = False
+    return TRANSFORMERS_AVAILABLE
+
+
+def _import_onnx() -> bool:
+    """Импортирует onnxruntime и optimum при первом вызове. Возвращает, доступны ли они."""
+    global ONNX_AVAILABLE, onnxruntime, ORTModelForCausalLM
+    if ONNX_AVAILABLE is not None:
+        return ONNX_AVAILABLE
+    with _import_lock:
+        if ONNX_AVAILABLE is None:
+            try:
+                import onnxruntime
+                from optimum.onnxruntime import ORTModelForCausalLM
+                ONNX_AVAILABLE = True
+            except ImportError:
+                ONNX_AVAILABLE = False
+    return ONNX_AVAILABLE
 
-# Опциональный импорт трансформеров с обработкой ошибок
-try:
-    import torch
-    from transformers import AutoTokenizer, AutoModelForCausalLM
-    TRANSFORMERS_AVAILABLE = True
-except ImportError as e:
-    print(f"⚠️ Transformers not available: {e}")
-    TRANSFORMERS_AVAILABLE = False
-    torch = None
-    AutoTokenizer = None
-    AutoModelForCausalLM = None
 
 _lock = threading.Lock()
-_tokenizer: Optional[AutoTokenizer] = None
-_model: Optional[AutoModelForCausalLM] = None
+_tokenizer: Optional[PreTrainedTokenizerBase] = None
+_model: Optional[PreTrainedModel] = None
 _model_loaded = False
+# Каким движком фактически выполняется инференс: "torch" или "onnx"
+_backend = "torch"
+# Состояние загрузки модели для эндпоинта готовности
+_load_status: Dict[str, Any] = {"state": "idle", "started_at": None, "seconds": None, "source": None, "error": None}
+# Сколько секунд запрос ждёт модель, которую грузит другой поток, прежде чем ответить заглушкой
+MODEL_LOAD_WAIT = float(os.environ.get("MODEL_LOAD_WAIT", "5"))
+# Через сколько секунд без запросов выгружать модель (0 — никогда)
+MODEL_IDLE_UNLOAD = float(os.environ.get("MODEL_IDLE_UNLOAD", "0"))
+# Предел RSS процесса в МБ: модель и дополнительные реплики сверх него не загружаются (0 — без предела)
+MODEL_MEMORY_BUDGET_MB = float(os.environ.get("MODEL_MEMORY_BUDGET_MB", "0"))
+
+# Токены статических префиксов промптов: вид -> список id
+_prefix_ids: Dict[str, List[int]] = {}
+# Предвычисленный KV-кэш статических префиксов промптов: вид -> (input_ids, past_key_values)
+_prefix_caches: Dict[str, tuple] = {}
+PREFIX_CACHE_ENABLED = os.environ.get("PREFIX_CACHE", "1") != "0"
+
+# Бюджет промпта в токенах (префикс + разговор); старые сообщения выкидываются первыми
+PROMPT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", "384"))
+# Сколько последних сообщений максимум попадает в контекст
+PROMPT_MAX_MESSAGES = int(os.environ.get("PROMPT_MAX_MESSAGES", "4"))
+# Сколько токенов первого сообщения учитывать при генерации названия
+TITLE_MESSAGE_TOKENS = int(os.environ.get("TITLE_MESSAGE_TOKENS", "64"))
+
+# LRU-кэш токенизации сообщений и служебных фрагментов: текст -> список id
+_token_cache: "OrderedDict[str, List[int]]" = OrderedDict()
+_token_cache_lock = threading.Lock()
+TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", "4096"))
 
 
 def _ensure_model_cache() -> str:
@@ -34,6 +116,62 @@ def _ensure_model_cache() -> str:
     return model_dir
 
 
+MODEL_NAME = "ai-forever/rugpt3small_based_on_gpt2"
+# Папка внутри model_cache с заранее сконвертированной int8-моделью
+_INT8_DIR_NAME = "rugpt3small-int8"
+_INT8_WEIGHTS_NAME = "model_int8.pt"
+
+
+# Папка внутри model_cache с экспортом модели в ONNX (с past_key_values)
+_ONNX_DIR_NAME = "rugpt3small-onnx"
+# Потоки ONNX Runtime внутри одного оператора; 0 — по числу ядер
+ONNX_THREADS = int(os.environ.get("ONNX_THREADS", "0"))
+
+
+# Папка внутри model_cache с копией весов в safetensors (загружается через mmap)
+_FAST_DIR_NAME = "rugpt3small-safetensors"
+
+
+def _find_fast_copy(model_dir: str) -> Optional[str]:
+    """Возвращает путь к safetensors-копии модели, если она уже сохранена."""
+    fast_dir = os.path.join(model_dir, _FAST_DIR_NAME)
+    if os.path.exists(os.path.join(fast_dir, "model.safetensors")) and os.path.exists(os.path.join(fast_dir, "config.json")):
+        return fast_dir
+    return None
+
+
+def _save_fast_copy(model_dir: str, tokenizer, model) -> None:
+    """
+    Сохраняет модель и токенизатор в safetensors. Такие веса отображаются в
+    память (mmap) без распаковки pickle, поэтому холодный старт заметно быстрее,
+    чем у pytorch_model.bin.
+    """
+    fast_dir = os.path.join(model_dir, _FAST_DIR_NAME)
+    tmp_dir = fast_dir + ".tmp"
+    try:
+        model.save_pretrained(tmp_dir, safe_serialization=True)
+        tokenizer.save_pretrained(tmp_dir)
+        if os.path.exists(fast_dir):
+            import shutil
+            shutil.rmtree(fast_dir)
+        os.replace(tmp_dir, fast_dir)
+        print(f"✅ Safetensors-копия модели сохранена: {fast_dir}")
+    except Exception as e:
+        print(f"⚠️ Не удалось сохранить safetensors-копию модели: {e}")
+
+
+def _requested_backend() -> str:
+    """Желаемый движок инференса: INFERENCE_BACKEND=onnx или torch (по умолчанию)."""
+    backend = os.environ.get("INFERENCE_BACKEND", "").strip().lower()
+    return "onnx" if backend == "onnx" else "torch"
+
+
+def _quantize_mode() -> str:
+    """Режим квантования модели: MODEL_QUANTIZE=int8 включает динамическое int8, иначе fp32."""
+    mode = os.environ.get("MODEL_QUANTIZE", "").strip().lower()
+    return "int8" if mode == "int8" else "fp32"
+
+
 def _find_model_in_cache(model_dir: str) -> Optional[str]:
     """Ищет модель по схеме: через refs/main -> snapshots."""
     base_path = os.path.join(model_dir, "models--ai-forever--rugpt3small_based_on_gpt2")
@@ -64,97 +202,479 @@ def _find_model_in_cache(model_dir: str) -> Optional[str]:
     return snapshot_path
 
 
-def _ensure_loaded() -> bool:
-    """Загружает модель. Возвращает True при успехе, False при ошибке."""
-    global _tokenizer, _model, _model_loaded
+def _ensure_loaded(wait: Optional[float] = None) -> bool:
+    """
+    Загружает модель. Возвращает True при успехе, False при ошибке.
+
+    Если модель уже грузит другой поток, ждёт не дольше wait секунд
+    (None — сколько потребуется) и возвращает False, если не дождался.
+    """
+    global _tokenizer, _model, _model_loaded, _backend
     
+    if _model_loaded:
+        return True
+
     # Если трансформеры не доступны, сразу выходим
-    if not TRANSFORMERS_AVAILABLE:
+    if not _import_ml():
         print("❌ Transformers not available - using fallback mode")
         return False
-        
-    if _model_loaded:
-        return True
 
-    with _lock:
+    if not _lock.acquire(timeout=-1 if wait is None else wait):
+        return False
+    try:
         if _model_loaded:
             return True
 
         model_dir = _ensure_model_cache()
+        started = time.perf_counter()
+        _load_status.update(state="loading", started_at=time.time(), seconds=None, error=None)
 
         try:
-            local_model_path = _find_model_in_cache(model_dir)
+            fast_path = _find_fast_copy(model_dir)
+            local_model_path = fast_path or _find_model_in_cache(model_dir)
             
             if local_model_path:
-                _tokenizer = AutoTokenizer.from_pretrained(local_model_path, local_files_only=True)
-                _model = AutoModelForCausalLM.from_pretrained(
-                    local_model_path,
-                    local_files_only=True,
-                    dtype=torch.float32,
-                    low_cpu_mem_usage=True
-                )
+                source, source_kwargs = local_model_path, dict(local_files_only=True)
             else:
-                model_name = "ai-forever/rugpt3small_based_on_gpt2"
-                _tokenizer = AutoTokenizer.from_pretrained(model_name, cache_dir=model_dir)
-                _model = AutoModelForCausalLM.from_pretrained(
-                    model_name,
-                    cache_dir=model_dir,
-                    dtype=torch.float32,
-                    low_cpu_mem_usage=True
+                source, source_kwargs = MODEL_NAME, dict(cache_dir=model_dir)
+
+            needed_mb = dir_size_mb(local_model_path) if local_model_path else 0.0
+            if not _lifecycle.memory_allows(needed_mb):
+                _lifecycle.count("refused_loads")
+                _load_status.update(
+                    state="refused", seconds=None,
+                    error=f"RSS {rss_mb():.0f} МБ + модель {needed_mb:.0f} МБ > бюджет {MODEL_MEMORY_BUDGET_MB:.0f} МБ",
                 )
+                print(f"⚠️ Модель не загружена: {_load_status['error']}")
+                return False
+
+            _tokenizer = AutoTokenizer.from_pretrained(source, **source_kwargs)
+            _model = None
+            _backend = "torch"
+            if _requested_backend() == "onnx":
+                _model = _load_onnx_model(model_dir, source, source_kwargs)
+                if _model is not None:
+                    _backend = "onnx"
+            if _model is None:
+                _model = _load_torch_model(model_dir, source, source_kwargs)
+                if fast_path is None and _quantize_mode() == "fp32":
+                    _save_fast_copy(model_dir, _tokenizer, _model)
 
             if _tokenizer.pad_token is None:
                 _tokenizer.pad_token = _tokenizer.eos_token
+            # Для батчей декодер-модели паддинг должен быть слева
+            _tokenizer.padding_side = "left"
             
-            _model.eval()
+            if _backend == "torch":
+                _model.eval()
+            with _token_cache_lock:
+                _token_cache.clear()
+            _warm_prefix_caches()
             _model_loaded = True
-            print("✅ AI model loaded successfully")
+            _load_status.update(
+                state="ready",
+                seconds=round(time.perf_counter() - started, 2),
+                source="safetensors" if fast_path else ("cache" if local_model_path else "hub"),
+            )
+            _lifecycle.loaded(_load_status["seconds"])
+            print(f"✅ AI model loaded successfully ({_backend}, {_load_status['seconds']} с)")
             return True
 
         except Exception as e:
+            _load_status.update(state="failed", seconds=round(time.perf_counter() - started, 2), error=str(e))
             print(f"❌ Ошибка загрузки модели: {e}")
             return False
+    finally:
+        _lock.release()
+
+
+def _unload_model() -> bool:
+    """Освобождает веса и кэши модели. False — модели нет или её сейчас грузит другой поток."""
+    global _tokenizer, _model, _model_loaded
+    if not _model_loaded or not _lock.acquire(blocking=False):
+        return False
+    try:
+        _model_loaded = False
+        _model = None
+        _tokenizer = None
+        _prefix_ids.clear()
+        _prefix_caches.clear()
+        with _token_cache_lock:
+            _token_cache.clear()
+        gc.collect()
+        _load_status.update(state="unloaded")
+        return True
+    finally:
+        _lock.release()
+
+
+# Модель не выгружается, пока ею пользуются, и не грузится сверх MODEL_MEMORY_BUDGET_MB
+_lifecycle = ModelLifecycle(MODEL_IDLE_UNLOAD, MODEL_MEMORY_BUDGET_MB, _unload_model)
+
+
+def preload_async() -> None:
+    """Начинает загрузку модели в фоне, чтобы первый пользователь не ждал её."""
+    if _inference_mode() == "server" or TRANSFORMERS_AVAILABLE is False or _model_loaded:
+        return
+    threading.Thread(target=_ensure_loaded, name="cosmocat-preload", daemon=True).start()
 
 
-def _build_prompt(messages: List[Dict[str, str]]) -> str:
-    system_prompt = (
-        "Ты — космический котик Космокот! Ты живёшь на космической станции, любишь молоко, коробки, лазить по клавиатуре и смотреть на звёзды. "
-        "Ты очень любознательный, добрый, но немного ленивый. Всегда отвечай от лица Космокота. "
-        "Отвечай КРАТКО - максимум 1-2 предложения! Добавляй 'мяу', 'мур' или кошачьи звуки и космические эмодзи в каждый ответ. "
-        "Будь игривым, забавным и милым, как настоящий котик в космосе! НЕ давай скучные, формальные или длинные ответы. "
-        "Всегда оставайся в роли Космокота, не выходи изキャラクター.\n\n"
-        "Примеры разговоров:\n"
-        "Человек: Привет!\n"
-        "Космокот: Мяу! Привет, землянин! Как твои дела в этом огромном космосе? 😺🚀\n\n"
-        "Человек: Расскажи о себе.\n"
-        "Космокот: Я Космокот, мурлыкаю на станции среди звёзд, обожаю молоко и коробки! Мурр! 🐱🌌\n\n"
-        "Человек: Что ты любишь есть?\n"
-        "Космокот: Молоко из галактики и космическую рыбку! Ням-ням, мяу! 🥛🐟\n\n"
-        "Человек: Как пройти в библиотеку?\n"
-        "Космокот: Ой, я не знаю, но могу полазить по клавиатуре и найти! Мяу, давай поищем вместе? 📚🐾\n\n"
-        "Теперь продолжи разговор от лица Космокота:"
+def model_status() -> Dict[str, Any]:
+    """Состояние загрузки модели: state (idle/loading/ready/failed), время загрузки, источник весов."""
+    if _inference_mode() == "server":
+        import inference_server
+        health = inference_server.health()
+        if health is None:
+            return {"state": "unavailable", "mode": "server"}
+        return dict(health, mode="server")
+    if TRANSFORMERS_AVAILABLE is False:
+        return {"state": "fallback", "mode": "local", "error": "transformers not available"}
+    status = dict(_load_status, mode="local", backend=_backend)
+    if status["state"] == "loading" and status["started_at"]:
+        status["elapsed"] = round(time.time() - status["started_at"], 2)
+    return status
+
+
+def _load_torch_model(model_dir: str, source: str, source_kwargs: Dict[str, Any]):
+    """Загружает модель для torch-бэкенда: fp32 или int8 в зависимости от MODEL_QUANTIZE."""
+    if _quantize_mode() == "int8":
+        return _load_int8_model(model_dir, source, source_kwargs)
+    return AutoModelForCausalLM.from_pretrained(
+        source,
+        dtype=torch.float32,
+        low_cpu_mem_usage=True,
+        **source_kwargs
     )
 
-    conversation = []
-    # Берем только последние 4 сообщения для контекста
-    valid_messages = messages[-4:]
-    
+
+def _conv1d_to_linear(model) -> None:
+    """
+    Заменяет GPT-2 Conv1D на nn.Linear с транспонированными весами.
+
+    Динамическое квантование PyTorch работает только с nn.Linear, а в GPT-2
+    все матрицы внимания и MLP сделаны через Conv1D.
+    """
+    for module in list(model.modules()):
+        for child_name, child in list(module.named_children()):
+            if isinstance(child, Conv1D):
+                linear = torch.nn.Linear(child.weight.shape[0], child.nf)
+                linear.weight.data = child.weight.data.t().contiguous()
+                linear.bias.data = child.bias.data
+                setattr(module, child_name, linear)
+
+
+def _quantize_int8(model):
+    """Динамическое int8-квантование всех Linear-слоёв модели."""
+    _conv1d_to_linear(model)
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def _load_int8_model(model_dir: str, source: str, source_kwargs: Dict[str, Any]):
+    """
+    Загружает int8-модель из model_cache, а если её там нет — квантует fp32-модель
+    и сохраняет результат, чтобы следующие запуски пропускали конвертацию.
+    """
+    int8_dir = os.path.join(model_dir, _INT8_DIR_NAME)
+    weights_path = os.path.join(int8_dir, _INT8_WEIGHTS_NAME)
+
+    if os.path.exists(weights_path) and os.path.exists(os.path.join(int8_dir, "config.json")):
+        config = AutoConfig.from_pretrained(int8_dir, local_files_only=True)
+        model = _quantize_int8(AutoModelForCausalLM.from_config(config))
+        # Файл создаётся этим же модулем; упакованные int8-веса не грузятся в режиме weights_only
+        model.load_state_dict(torch.load(weights_path, map_location="cpu", weights_only=False))
+        print(f"✅ Int8-модель загружена из кэша: {int8_dir}")
+        return model
+
+    model = AutoModelForCausalLM.from_pretrained(
+        source,
+        dtype=torch.float32,
+        low_cpu_mem_usage=True,
+        **source_kwargs
+    )
+    model.eval()
+    model = _quantize_int8(model)
+
+    try:
+        os.makedirs(int8_dir, exist_ok=True)
+        model.config.save_pretrained(int8_dir)
+        tmp_path = weights_path + ".tmp"
+        torch.save(model.state_dict(), tmp_path)
+        os.replace(tmp_path, weights_path)
+        print(f"✅ Int8-модель сохранена в кэш: {int8_dir}")
+    except Exception as e:
+        print(f"⚠️ Не удалось сохранить int8-модель: {e}")
+    return model
+
+
+def _onnx_session_options():
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = ONNX_THREADS
+    # Запросы и так приходят из разных потоков — параллелизм между операторами не нужен
+    options.inter_op_num_threads = 1
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return options
+
+
+def _load_onnx_model(model_dir: str, source: str, source_kwargs: Dict[str, Any]):
+    """
+    Загружает ONNX-экспорт модели из model_cache и запускает его через onnxruntime.
+
+    Если экспорта нет, он делается один раз и сохраняется. Возвращает None,
+    когда onnxruntime/optimum не установлены или экспорт не удался — тогда
+    вызывающий код остаётся на torch.
+    """
+    if not _import_onnx():
+        print("⚠️ onnxruntime/optimum не установлены — используется torch")
+        return None
+
+    onnx_dir = os.path.join(model_dir, _ONNX_DIR_NAME)
+    try:
+        if not os.path.exists(os.path.join(onnx_dir, "model.onnx")):
+            print("⏳ Экспорт модели в ONNX...")
+            exported = ORTModelForCausalLM.from_pretrained(source, export=True, use_cache=True, **source_kwargs)
+            exported.save_pretrained(onnx_dir)
+            print(f"✅ ONNX-экспорт сохранён в кэш: {onnx_dir}")
+
+        return ORTModelForCausalLM.from_pretrained(
+            onnx_dir,
+            use_cache=True,
+            local_files_only=True,
+            provider="CPUExecutionProvider",
+            session_options=_onnx_session_options(),
+        )
+    except Exception as e:
+        print(f"⚠️ ONNX-бэкенд недоступен, используется torch: {e}")
+        return None
+
+
+def _prompt_prefixes() -> Dict[str, str]:
+    """Статические префиксы промптов по видам запросов."""
+    return {"reply": _REPLY_PROMPT_PREFIX, "title": _TITLE_PROMPT_PREFIX}
+
+
+def _warm_prefix_caches() -> None:
+    """Токенизирует статические префиксы и один раз прогоняет их через модель ради past_key_values."""
+    _prefix_ids.clear()
+    _prefix_caches.clear()
+
+    device = _model.device
+    for kind, prefix in _prompt_prefixes().items():
+        ids = _tokenizer(prefix).input_ids
+        _prefix_ids[kind] = ids
+        # ONNX-сессия ведёт past_key_values сама, готовый DynamicCache ей не передать
+        if not PREFIX_CACHE_ENABLED or _backend != "torch":
+            continue
+        if len(ids) >= PROMPT_TOKEN_BUDGET:
+            print(f"⚠️ Префикс '{kind}' длиннее бюджета {PROMPT_TOKEN_BUDGET} токенов — KV-кэш отключён")
+            continue
+
+        prefix_tensor = torch.tensor([ids], dtype=torch.long, device=device)
+        with torch.no_grad():
+            past = _model(prefix_tensor, past_key_values=DynamicCache(), use_cache=True).past_key_values
+        _prefix_caches[kind] = (prefix_tensor, past)
+        print(f"✅ KV-кэш префикса '{kind}' готов ({len(ids)} токенов)")
+
+
+def _encode_batch(kind: str, suffixes: List[List[int]], use_prefix_cache: bool = True):
+    """
+    Готовит входы generate() для батча промптов одного вида из готовых id.
+
+    С KV-кэшем префикс берётся готовым, а паддинг ставится между префиксом и
+    разговором: позиции считаются по attention_mask, поэтому для модели это
+    эквивалентно обычному промпту. Без кэша промпт целиком дополняется
+    паддингом слева. Возвращает (input_ids, attention_mask, past_key_values).
+    """
+    device = _model.device
+    cached = _prefix_caches.get(kind) if use_prefix_cache else None
+    pad_id = _tokenizer.pad_token_id
+
+    if cached is None:
+        rows = [_prefix_ids[kind] + ids for ids in suffixes]
+    else:
+        rows = suffixes
+    width = max(len(row) for row in rows)
+    input_ids = torch.tensor([[pad_id] * (width - len(row)) + row for row in rows], dtype=torch.long, device=device)
+    attention_mask = torch.tensor([[0] * (width - len(row)) + [1] * len(row) for row in rows], dtype=torch.long, device=device)
+
+    if cached is None:
+        return input_ids, attention_mask, None
+
+    prefix_tensor, prefix_past = cached
+    batch_size = len(suffixes)
+    input_ids = torch.cat([prefix_tensor.expand(batch_size, -1), input_ids], dim=1)
+    attention_mask = torch.cat([torch.ones_like(prefix_tensor).expand(batch_size, -1), attention_mask], dim=1)
+
+    # generate() дописывает в кэш, поэтому каждому запуску нужна своя копия
+    past = copy.deepcopy(prefix_past)
+    if batch_size > 1:
+        past.batch_repeat_interleave(batch_size)
+    return input_ids, attention_mask, past
+
+
+def _tokenize_cached(text: str) -> List[int]:
+    """Токенизирует фрагмент промпта, запоминая результат в LRU-кэше."""
+    with _token_cache_lock:
+        ids = _token_cache.get(text)
+        if ids is not None:
+            _token_cache.move_to_end(text)
+            return ids
+
+    ids = _tokenizer.encode(text, add_special_tokens=False)
+
+    with _token_cache_lock:
+        _token_cache[text] = ids
+        while len(_token_cache) > TOKEN_CACHE_SIZE:
+            _token_cache.popitem(last=False)
+    return ids
+
+
+def _message_ids(speaker: str, content: str) -> tuple[List[int], List[int]]:
+    """
+    Токены одной реплики: заголовок "\nЧеловек:" и текст " ...".
+
+    Фрагменты начинаются с пробельного символа, а заканчиваются не пробельным,
+    поэтому склейка их id совпадает с токенизацией склеенной строки.
+    """
+    return _tokenize_cached(f"\n{speaker}:"), _tokenize_cached(f" {content}")
+
+
+def _assemble_reply_ids(messages: List[Dict[str, str]]) -> List[int]:
+    """
+    Изменяемая часть промпта ответа в токенах: последние реплики разговора.
+
+    Берётся не больше PROMPT_MAX_MESSAGES сообщений, и вместе с префиксом они
+    должны уложиться в PROMPT_TOKEN_BUDGET: старые сообщения выкидываются
+    первыми, а слишком длинное последнее сообщение обрезается слева, чтобы
+    модель всегда видела конец свежей реплики.
+    """
+    turns = []
+    # Берем только последние сообщения для контекста
+    valid_messages = messages[-PROMPT_MAX_MESSAGES:]
+
     for msg in valid_messages:
         role = msg.get("role", "").strip()
         content = msg.get("content", "").strip()
         if not content:
             continue
         if role == "user":
-            conversation.append(f"Человек: {content}")
+            turns.append(("Человек", content))
         elif role == "assistant":
-            conversation.append(f"Космокот: {content}")
+            turns.append(("Космокот", content))
 
     # Если это начало диалога, добавляем приветствие
     if not valid_messages:
-        conversation.append("Человек: Привет!")
+        turns.append(("Человек", "Привет!"))
+
+    tail = _tokenize_cached("\nКосмокот:")
+    budget = PROMPT_TOKEN_BUDGET - len(_prefix_ids["reply"]) - len(tail)
+
+    picked: List[List[int]] = []
+    for speaker, content in reversed(turns):
+        header, body = _message_ids(speaker, content)
+        if len(header) + len(body) <= budget:
+            picked.append(header + body)
+            budget -= len(header) + len(body)
+            continue
+        if not picked and budget > len(header):
+            # Самое свежее сообщение не влезает целиком — оставляем его конец
+            picked.append(header + body[len(body) - (budget - len(header)):])
+        break
+
+    ids: List[int] = []
+    for chunk in reversed(picked):
+        ids.extend(chunk)
+    return ids + tail
+
+
+_REPLY_PROMPT_PREFIX = (
+    "Ты — космический котик Космокот! Ты живёшь на космической станции, любишь молоко, коробки, лазить по клавиатуре и смотреть на звёзды. "
+    "Ты очень любознательный, добрый, но немного ленивый. Всегда отвечай от лица Космокота. "
+    "Отвечай КРАТКО - максимум 1-2 предложения! Добавляй 'мяу', 'мур' или кошачьи звуки и космические эмодзи в каждый ответ. "
+    "Будь игривым, забавным и милым, как настоящий котик в космосе! НЕ давай скучные, формальные или длинные ответы. "
+    "Всегда оставайся в роли Космокота, не выходи изキャラクター.\n\n"
+    "Примеры разговоров:\n"
+    "Человек: Привет!\n"
+    "Космокот: Мяу! Привет, землянин! Как твои дела в этом огромном космосе? 😺🚀\n\n"
+    "Человек: Расскажи о себе.\n"
+    "Космокот: Я Космокот, мурлыкаю на станции среди звёзд, обожаю молоко и коробки! Мурр! 🐱🌌\n\n"
+    "Человек: Что ты любишь есть?\n"
+    "Космокот: Молоко из галактики и космическую рыбку! Ням-ням, мяу! 🥛🐟\n\n"
+    "Человек: Как пройти в библиотеку?\n"
+    "Космокот: Ой, я не знаю, но могу полазить по клавиатуре и найти! Мяу, давай поищем вместе? 📚🐾\n\n"
+    "Теперь продолжи разговор от лица Космокота:"
+)
+
+# Фразы, после которых модель начинает писать за собеседника
+_STOP_PHRASES = [
+    "Человек:", "Пользователь:", "User:", "Assistant:",
+    "System:", "\nЧеловек", "\nПользователь", "Космокот:"
+]
+
+
+def _cut_at_stop_phrase(text: str) -> tuple[str, bool]:
+    """Обрезает текст по первой стоп-фразе. Возвращает (текст, найдена ли стоп-фраза)."""
+    found = False
+    for stop in _STOP_PHRASES:
+        idx = text.find(stop)
+        if idx != -1:
+            text = text[:idx].strip()
+            found = True
+    return text, found
+
+
+def _stop_phrase_holdback(text: str) -> int:
+    """Сколько символов в конце текста могут оказаться началом стоп-фразы."""
+    longest = 0
+    for stop in _STOP_PHRASES:
+        for size in range(min(len(stop) - 1, len(text)), longest, -1):
+            if text.endswith(stop[:size]):
+                longest = size
+                break
+    return longest
+
+
+# Ограничения ответа Космокота: столько предложений и символов остаётся после очистки
+REPLY_MAX_SENTENCES = 2
+REPLY_MAX_CHARS = 120
+# Ограничение длины названия чата
+TITLE_MAX_CHARS = 50
+
+
+def _drop_noise_words(text: str) -> str:
+    """Удаляет слова, которые выглядят как случайный шум."""
+    words = text.split()
+    if len(words) > 2:
+        cleaned_words = []
+        for word in words:
+            # Пропускаем слова, которые выглядят как случайный шум
+            if len(word) > 20 or word.count('.') > 3:
+                continue
+            cleaned_words.append(word)
+        text = ' '.join(cleaned_words)
+    return text
+
+
+def _complete_sentences(text: str) -> int:
+    """Сколько непустых предложений уже закрыто знаком препинания и продолжено дальше."""
+    parts = re.split(r'[.!?]+(?=[^.!?])', text)
+    return sum(1 for part in parts[:-1] if part.strip())
+
+
+def _reply_is_complete(text: str) -> bool:
+    """Ответ уже не изменится после _clean_reply, сколько бы токенов ни добавилось."""
+    text, stopped = _cut_at_stop_phrase(text.lstrip())
+    if stopped:
+        return True
+    text = _drop_noise_words(re.sub(r'\s+', ' ', text).strip())
+    return _complete_sentences(text) >= REPLY_MAX_SENTENCES or len(text) >= REPLY_MAX_CHARS
+
+
+def _title_is_complete(text: str) -> bool:
+    """Название обрезается по первому концу строки или предложения и до TITLE_MAX_CHARS символов."""
+    # Ведущие пробелы и переводы строк снимаются при очистке, поэтому не считаются
+    text = text.lstrip()
+    return bool(re.search(r'[.!?\n]', text)) or len(text) >= TITLE_MAX_CHARS
 
-    prompt = system_prompt + "\n" + "\n".join(conversation) + "\nКосмокот:"
-    return prompt
 
 def _truncate_to_sentences(text: str, max_sentences: int) -> str:
     """Обрезает текст до указанного количества предложений."""
@@ -162,41 +682,30 @@ def _truncate_to_sentences(text: str, max_sentences: int) -> str:
     sentences = [s.strip() for s in sentences if s.strip()]
     return '. '.join(sentences[:max_sentences]) + ('.' if sentences else '')
 
+# Заглушки _clean_reply вместо пустого или бессвязного ответа модели
+_EMPTY_REPLY = "Мяу? Я не понял... Попробуй ещё раз! 😺"
+_UNUSABLE_REPLY = "Мяу! Интересный вопрос, но я подумаю! 🐱"
+
 def _clean_reply(reply: str) -> str:
     """Тщательная очистка ответа от бессвязного текста."""
     if not reply:
-        return "Мяу? Я не понял... Попробуй ещё раз! 😺"
+        return _EMPTY_REPLY
+    
+    # Удаляем всё после стоп-фраз (до схлопывания пробелов, чтобы работали "\nЧеловек" и т.п.)
+    reply, _ = _cut_at_stop_phrase(reply)
     
     # Убираем лишние пробелы
     reply = re.sub(r'\s+', ' ', reply).strip()
     
-    # Удаляем всё после стоп-фраз
-    stop_phrases = [
-        "Человек:", "Пользователь:", "User:", "Assistant:", 
-        "System:", "\nЧеловек", "\nПользователь", "Космокот:"
-    ]
-    for stop in stop_phrases:
-        idx = reply.find(stop)
-        if idx != -1:
-            reply = reply[:idx].strip()
-    
     # Удаляем бессмысленные повторения и случайный текст
-    words = reply.split()
-    if len(words) > 2:
-        cleaned_words = []
-        for word in words:
-            # Пропускаем слова, которые выглядят как случайный шум
-            if len(word) > 20 or word.count('.') > 3:
-                continue
-            cleaned_words.append(word)
-        reply = ' '.join(cleaned_words)
+    reply = _drop_noise_words(reply)
     
     # Обрезаем до 2 предложений максимум
-    reply = _truncate_to_sentences(reply, 2)
+    reply = _truncate_to_sentences(reply, REPLY_MAX_SENTENCES)
     
     # Дополнительная проверка: если пусто или бессмысленно
     if not reply or len(reply) < 5 or reply.count(' ') < 1 or all(c in '.,!?;:' for c in reply.replace(' ', '')):
-        return "Мяу! Интересный вопрос, но я подумаю! 🐱"
+        return _UNUSABLE_REPLY
     
     # Добавляем кошачий элемент если его нет
     cat_keywords = ['мяу', 'мур', 'mur', 'meow', '🐱', '😺', '🚀', '💫', '🌌']
@@ -205,147 +714,617 @@ def _clean_reply(reply: str) -> str:
         reply += random.choice(cat_elements)
     
     # Ограничиваем общую длину
-    return reply[:120].strip()
+    return reply[:REPLY_MAX_CHARS].strip()
+
+
+_REPLY_FALLBACKS = [
+    "Мяу! Космокот на связи! 🐱🚀",
+    "Привет! Я тут, в космосе! ✨",
+    "Мур-мур! Рад тебя видеть! 😺",
+    "Космокот в эфире! 🛰️"
+]
+
+# Параметры генерации ответа Космокота
+_REPLY_GENERATION_KWARGS: Dict[str, Any] = dict(
+    max_new_tokens=60,
+    temperature=0.6,  # Понизили для большей coherentности
+    do_sample=True,
+    repetition_penalty=1.2,  # Увеличили чтобы избежать повторений
+    no_repeat_ngram_size=4,  # Увеличили
+    top_p=0.8,  # Понизили для фокуса
+    top_k=20,  # Понизили
+)
+
+# Сколько секунд ждать очередной токен от стримера
+STREAM_TOKEN_TIMEOUT = float(os.environ.get("STREAM_TOKEN_TIMEOUT", "30"))
 
 
-def generate_reply(messages: List[Dict[str, str]]) -> str:
+class _UsableOutputCriteria:
     """
-    Генерирует ответ с улучшенным контролем качества.
+    Критерий остановки для generate() (протокол transformers.StoppingCriteria:
+    вызывается с input_ids и scores, возвращает bool-тензор по строкам батча).
+
+    Останавливает строки батча, как только их текст стал пригодным ответом:
+    дальнейшие токены всё равно были бы отрезаны при очистке.
     """
-    if not _ensure_loaded():
-        fallback_responses = [
-            "Мяу! Космокот на связи! 🐱🚀",
-            "Привет! Я тут, в космосе! ✨",
-            "Мур-мур! Рад тебя видеть! 😺", 
-            "Космокот в эфире! 🛰️"
-        ]
-        return random.choice(fallback_responses)
 
+    def __init__(self, prompt_length: int, is_complete: Callable[[str], bool]) -> None:
+        self.prompt_length = prompt_length
+        self.is_complete = is_complete
+        # строка батча -> сколько новых токенов было сгенерировано до остановки
+        self.stopped_at: Dict[int, int] = {}
+
+    def __call__(self, input_ids, scores, **kwargs):
+        generated = input_ids.shape[1] - self.prompt_length
+        done = []
+        for row in range(input_ids.shape[0]):
+            if row not in self.stopped_at:
+                text = _tokenizer.decode(input_ids[row, self.prompt_length:], skip_special_tokens=True)
+                if self.is_complete(text):
+                    self.stopped_at[row] = generated
+            done.append(row in self.stopped_at)
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+
+class _DeadlineCriteria:
+    """
+    Жёсткий дедлайн: строка батча останавливается, когда время её запроса вышло.
+    Тот же протокол, что у transformers.StoppingCriteria.
+    """
+
+    def __init__(self, deadlines: List[Optional[float]]) -> None:
+        # Для каждой строки батча — момент time.monotonic() или None (без дедлайна)
+        self.deadlines = deadlines
+        self.expired: set = set()
+
+    def __call__(self, input_ids, scores, **kwargs):
+        now = time.monotonic()
+        for row, deadline in enumerate(self.deadlines):
+            if deadline is not None and now >= deadline:
+                self.expired.add(row)
+        done = [row in self.expired for row in range(input_ids.shape[0])]
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+
+class _DeadlineExceeded(Exception):
+    """Дедлайн запроса истёк раньше, чем модель выдала пригодный текст."""
+
+
+def _completion_check(kind: str) -> Callable[[str], bool]:
+    return _title_is_complete if kind == "title" else _reply_is_complete
+
+
+_early_stop_lock = threading.Lock()
+_early_stop_stats: Dict[str, Dict[str, int]] = {}
+
+
+def _record_early_stop(kind: str, max_new_tokens: int, criteria: _UsableOutputCriteria, batch_size: int) -> None:
+    """Считает, сколько токенов сэкономила досрочная остановка."""
+    with _early_stop_lock:
+        stats = _early_stop_stats.setdefault(kind, {"requests": 0, "early_stopped": 0, "tokens_saved": 0})
+        stats["requests"] += batch_size
+        for generated in criteria.stopped_at.values():
+            stats["early_stopped"] += 1
+            stats["tokens_saved"] += max(0, max_new_tokens - generated)
+
+
+def _early_stop_metrics() -> Dict[str, Any]:
+    with _early_stop_lock:
+        return {
+            kind: dict(stats, avg_tokens_saved=round(stats["tokens_saved"] / stats["requests"], 2) if stats["requests"] else 0.0)
+            for kind, stats in _early_stop_stats.items()
+        }
+
+
+# Настройки микробатчинга: сколько запросов склеивать и сколько ждать попутчиков
+BATCH_MAX_SIZE = max(1, int(os.environ.get("BATCH_MAX_SIZE", "4")))
+BATCH_WAIT_MS = max(0.0, float(os.environ.get("BATCH_WAIT_MS", "15")))
+
+# Пул реплик: сколько generate() выполняется одновременно и сколько потоков у каждого
+MODEL_REPLICAS = max(1, int(os.environ.get("MODEL_REPLICAS", "1")))
+# 0 — поделить доступные ядра поровну между репликами
+REPLICA_THREADS = max(0, int(os.environ.get("REPLICA_THREADS", "0")))
+# Закрепить каждую реплику за своим набором ядер (только Linux)
+REPLICA_PIN_CORES = os.environ.get("REPLICA_PIN_CORES", "0") == "1"
+
+
+def _available_cores() -> List[int]:
     try:
-        assert _tokenizer is not None and _model is not None
-        
-        prompt = _build_prompt(messages)
-
-        inputs = _tokenizer(
-            prompt,
-            return_tensors="pt",
-            max_length=256,
-            truncation=True,
-            padding=False
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(os.cpu_count() or 1))
+
+
+def _replica_threads() -> int:
+    return REPLICA_THREADS or max(1, len(_available_cores()) // MODEL_REPLICAS)
+
+
+def _replica_cores(slot: int) -> List[int]:
+    """Ядра реплики: подряд идущие блоки по _replica_threads() ядер."""
+    cores = _available_cores()
+    threads = min(_replica_threads(), len(cores))
+    start = (slot * threads) % len(cores)
+    return [cores[(start + i) % len(cores)] for i in range(threads)]
+
+
+def _configure_replica_thread(slot: int) -> None:
+    """
+    Настраивает поток реплики перед первым generate(). В OpenMP-сборке PyTorch
+    число потоков и привязка к ядрам наследуются командой потоков, которую
+    создаёт именно этот поток, поэтому реплики не делят один пул потоков.
+    """
+    if torch is not None:
+        torch.set_num_threads(_replica_threads())
+    if REPLICA_PIN_CORES and hasattr(os, "sched_setaffinity"):
+        try:
+            # pid 0 в Linux означает вызывающий поток
+            os.sched_setaffinity(0, _replica_cores(slot))
+        except OSError as e:
+            print(f"⚠️ Не удалось закрепить реплику {slot} за ядрами: {e}")
+
+
+def _generate_batch(batch: List[GenerationRequest]) -> List[str]:
+    """Один вызов generate() на батч запросов одного вида; тексты новых токенов по строкам."""
+    kind = batch[0].kind
+    generation_kwargs = batch[0].generation_kwargs
+    input_ids, attention_mask, past = _encode_batch(kind, [item.suffix_ids for item in batch])
+    criteria = _UsableOutputCriteria(input_ids.shape[1], _completion_check(kind))
+    deadline = _DeadlineCriteria([item.deadline for item in batch])
+    extra = dict(streamer=batch[0].streamer) if batch[0].streamer is not None else {}
+
+    with torch.no_grad():
+        outputs = _model.generate(
+            input_ids,
+            attention_mask=attention_mask,
+            past_key_values=past,
+            pad_token_id=_tokenizer.pad_token_id,
+            eos_token_id=_tokenizer.eos_token_id,
+            stopping_criteria=StoppingCriteriaList(batch[0].extra_criteria + [criteria, deadline]),
+            **extra,
+            **generation_kwargs,
         )
+    _record_early_stop(kind, generation_kwargs["max_new_tokens"], criteria, len(batch))
+    for row in deadline.expired - set(criteria.stopped_at):
+        batch[row].deadline_hit = True
+        _record_budget("deadline_hit")
 
-        device = next(_model.parameters()).device
-        input_ids = inputs.input_ids.to(device)
-        attention_mask = inputs.attention_mask.to(device) if inputs.attention_mask is not None else None
+    # Декодируем только новые токены каждой строки батча
+    new_tokens = outputs[:, input_ids.shape[1]:]
+    return [
+        _tokenizer.decode(row, skip_special_tokens=True).strip()
+        for row in new_tokens
+    ]
 
-        with torch.no_grad():
-            outputs = _model.generate(
-                input_ids,
-                attention_mask=attention_mask,
-                max_new_tokens=60,
-                temperature=0.6,  # Понизили для большей coherentности
-                do_sample=True,
-                pad_token_id=_tokenizer.pad_token_id,
-                eos_token_id=_tokenizer.eos_token_id, 
-                repetition_penalty=1.2,  # Увеличили чтобы избежать повторений
-                no_repeat_ngram_size=4,  # Увеличили
-                top_p=0.8,  # Понизили для фокуса
-                top_k=20,  # Понизили
-            )
 
-        # Декодируем только новые токены
-        new_tokens = outputs[0][input_ids.shape[1]:]
-        reply = _tokenizer.decode(new_tokens, skip_special_tokens=True).strip()
+def _can_add_replica() -> bool:
+    """Новая реплика запускается, только если RSS процесса укладывается в MODEL_MEMORY_BUDGET_MB."""
+    if _lifecycle.memory_allows(0):
+        return True
+    _lifecycle.count("refused_replicas")
+    return False
 
-        # Тщательная очистка
-        cleaned_reply = _clean_reply(reply)
-        
-        # Дополнительная проверка качества
-        if len(cleaned_reply) < 5 or cleaned_reply.count(' ') < 1:
-            return "Мяу! Не могу придумать хороший ответ... Спроси по-другому! 😿"
+
+_scheduler = InferenceScheduler(
+    BATCH_MAX_SIZE, BATCH_WAIT_MS, MODEL_REPLICAS, _generate_batch,
+    can_add_replica=_can_add_replica,
+    configure_thread=_configure_replica_thread,
+    on_expired=lambda item: _record_budget("expired_in_queue"),
+)
+
+
+def _submit(kind: str, suffix_ids: List[int], generation_kwargs: Dict[str, Any],
+            deadline: Optional[float] = None) -> str:
+    """
+    Ставит запрос (токены изменяемой части промпта) в очередь и ждёт декодированный текст новых токенов.
+    Бросает _DeadlineExceeded, если к дедлайну текст так и не стал пригодным.
+    """
+    item = _scheduler.submit(GenerationRequest(kind, suffix_ids, generation_kwargs, deadline=deadline))
+    text = item.result or ""
+    if item.deadline_hit and not _completion_check(kind)(text):
+        raise _DeadlineExceeded(f"{kind}: дедлайн истёк")
+    return text
+
+
+# Жёсткий дедлайн ответа в секундах с момента, когда ход принят в очередь (0 — без дедлайна)
+REPLY_DEADLINE = float(os.environ.get("REPLY_DEADLINE", "20"))
+# Глубина очереди, с которой ответы становятся короче, и с которой — ещё и без сэмплирования
+LOAD_SOFT_DEPTH = int(os.environ.get("LOAD_SOFT_DEPTH", "4"))
+LOAD_HARD_DEPTH = int(os.environ.get("LOAD_HARD_DEPTH", "8"))
+LOAD_SOFT_MAX_TOKENS = int(os.environ.get("LOAD_SOFT_MAX_TOKENS", "40"))
+LOAD_HARD_MAX_TOKENS = int(os.environ.get("LOAD_HARD_MAX_TOKENS", "24"))
+
+# Внешняя очередь перед моделью (например, admission в job_manager), тоже считается нагрузкой
+_load_probe: Optional[Callable[[], int]] = None
+
+_budget_lock = threading.Lock()
+_budget_stats: Dict[str, int] = {}
+
+
+def set_load_probe(probe: Optional[Callable[[], int]]) -> None:
+    """Регистрирует функцию, возвращающую число запросов, ждущих модель вне планировщика."""
+    global _load_probe
+    _load_probe = probe
+
+
+def _load_depth() -> int:
+    depth = _scheduler.queue_depth()
+    if _load_probe is not None:
+        try:
+            depth += _load_probe()
+        except Exception:
+            pass
+    return depth
+
+
+def _adaptive_generation_kwargs(base: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Параметры генерации с поправкой на нагрузку: под нагрузкой ответ короче,
+    под сильной нагрузкой — жадное декодирование вместо сэмплирования.
+    """
+    depth = _load_depth()
+    if depth >= LOAD_HARD_DEPTH:
+        kwargs = {k: v for k, v in base.items() if k not in ("temperature", "top_p", "top_k")}
+        kwargs.update(do_sample=False, max_new_tokens=min(base["max_new_tokens"], LOAD_HARD_MAX_TOKENS))
+        _record_budget("level_hard")
+        return kwargs
+    if depth >= LOAD_SOFT_DEPTH:
+        _record_budget("level_soft")
+        return dict(base, max_new_tokens=min(base["max_new_tokens"], LOAD_SOFT_MAX_TOKENS))
+    _record_budget("level_normal")
+    return base
+
+
+def reply_deadline() -> Optional[float]:
+    """
+    Дедлайн ответа (по time.monotonic()), который отсчитывается с момента, когда
+    ход принят: в REPLY_DEADLINE входят и очередь, и ожидание загрузки модели.
+    """
+    return time.monotonic() + REPLY_DEADLINE if REPLY_DEADLINE > 0 else None
+
+
+def _deadline_passed(deadline: Optional[float]) -> bool:
+    return deadline is not None and time.monotonic() >= deadline
+
+
+def _load_wait(deadline: Optional[float]) -> float:
+    """Сколько ждать чужую загрузку модели, не выходя за дедлайн"""
+    if deadline is None:
+        return MODEL_LOAD_WAIT
+    return max(0.0, min(MODEL_LOAD_WAIT, deadline - time.monotonic()))
+
+
+def _record_budget(event: str) -> None:
+    with _budget_lock:
+        _budget_stats[event] = _budget_stats.get(event, 0) + 1
+
+
+def _budget_metrics() -> Dict[str, Any]:
+    with _budget_lock:
+        counts = dict(_budget_stats)
+    return {
+        "deadline_seconds": REPLY_DEADLINE,
+        "soft_depth": LOAD_SOFT_DEPTH,
+        "hard_depth": LOAD_HARD_DEPTH,
+        "soft_max_tokens": LOAD_SOFT_MAX_TOKENS,
+        "hard_max_tokens": LOAD_HARD_MAX_TOKENS,
+        "load_depth": _load_depth(),
+        "counts": counts,
+    }
+
+
+def _inference_mode() -> str:
+    """
+    Где выполняется инференс: INFERENCE_MODE=server — в отдельном процессе
+    inference_server (модель одна на все веб-воркеры), иначе локально в этом процессе.
+    """
+    mode = os.environ.get("INFERENCE_MODE", "").strip().lower()
+    return "server" if mode == "server" else "local"
+
+
+def get_metrics() -> Dict[str, Any]:
+    """Метрики инференса для эндпоинта /api/metrics."""
+    if _inference_mode() == "server":
+        import inference_server
+        return {"mode": "server", "server": inference_server.get_metrics()}
+    return {
+        "mode": "local",
+        "model_loaded": _model_loaded,
+        "load": model_status(),
+        "backend": _backend,
+        "quantization": _quantize_mode() if _backend == "torch" else None,
+        "batching": dict(_scheduler.stats(), threads_per_replica=_replica_threads(), pinned=REPLICA_PIN_CORES),
+        "early_stop": _early_stop_metrics(),
+        "budget": _budget_metrics(),
+        "reply_cache": dict(_reply_cache.stats(), enabled=REPLY_CACHE_ENABLED),
+        "lifecycle": _lifecycle.stats(),
+    }
+
+
+_NO_GOOD_REPLY = "Мяу! Не могу придумать хороший ответ... Спроси по-другому! 😿"
+
+
+# Кэш ответов на короткие типовые реплики ("Привет!", "Как дела?")
+REPLY_CACHE_ENABLED = os.environ.get("REPLY_CACHE", "1") != "0"
+# Сколько разных ключей помнить и сколько секунд
+REPLY_CACHE_SIZE = int(os.environ.get("REPLY_CACHE_SIZE", "1024"))
+REPLY_CACHE_TTL = float(os.environ.get("REPLY_CACHE_TTL", "3600"))
+# Сколько разных ответов копить на ключ, прежде чем перестать звать модель
+REPLY_CACHE_POOL = int(os.environ.get("REPLY_CACHE_POOL", "4"))
+# Кэшируются только короткие разговоры из коротких сообщений
+REPLY_CACHE_MAX_MESSAGES = int(os.environ.get("REPLY_CACHE_MAX_MESSAGES", "3"))
+REPLY_CACHE_MAX_CHARS = int(os.environ.get("REPLY_CACHE_MAX_CHARS", "40"))
+
+
+_reply_cache = ReplyCache(
+    REPLY_CACHE_SIZE, REPLY_CACHE_TTL, REPLY_CACHE_POOL, REPLY_CACHE_MAX_MESSAGES, REPLY_CACHE_MAX_CHARS,
+)
+
+
+def _cached_reply(messages: List[Dict[str, str]]) -> tuple:
+    """(ключ кэша или None, готовый ответ из кэша или None)"""
+    key = _reply_cache.key(messages) if REPLY_CACHE_ENABLED else None
+    return key, (_reply_cache.get(key) if key is not None else None)
+
+
+def _remember_reply(key: Optional[str], reply: str, from_model: bool) -> None:
+    # Заглушки и ошибки в кэш не попадают — только настоящие ответы модели
+    if key is not None and from_model:
+        _reply_cache.add(key, reply)
+
+
+def _finalize_reply(reply: str) -> tuple:
+    """
+    Очищает сырой ответ модели и проверяет его качество.
+    Возвращает (текст, from_model): from_model=False, если вместо ответа подставлена заглушка.
+    """
+    # Тщательная очистка
+    cleaned_reply = _clean_reply(reply)
+    if cleaned_reply in (_EMPTY_REPLY, _UNUSABLE_REPLY):
+        return cleaned_reply, False
+
+    # Дополнительная проверка качества
+    if len(cleaned_reply) < 5 or cleaned_reply.count(' ') < 1:
+        return _NO_GOOD_REPLY, False
+
+    return cleaned_reply, True
+
+
+def generate_reply(messages: List[Dict[str, str]], deadline: Optional[float] = None) -> str:
+    """
+    Генерирует ответ с улучшенным контролем качества.
+    deadline — результат reply_deadline() в момент, когда ход принят (None — отсчёт с этого вызова).
+    """
+    if _inference_mode() == "server":
+        import inference_server
+        return inference_server.generate_reply(messages, deadline)
+    return _generate_reply_local(messages, deadline or reply_deadline())
+
+
+def _generate_reply_local(messages: List[Dict[str, str]], deadline: Optional[float]) -> str:
+    cache_key, cached = _cached_reply(messages)
+    if cached is not None:
+        return cached
+    if _deadline_passed(deadline):
+        # Время вышло, пока ход ждал очереди: модель не запускаем
+        _record_budget("expired_before_start")
+        return random.choice(_REPLY_FALLBACKS)
+    with _lifecycle.in_use():
+        return _generate_reply_model(messages, cache_key, deadline)
+
+
+def _generate_reply_model(messages: List[Dict[str, str]], cache_key: Optional[str], deadline: Optional[float]) -> str:
+    if not _ensure_loaded(_load_wait(deadline)):
+        return random.choice(_REPLY_FALLBACKS)
+
+    try:
+        assert _tokenizer is not None and _model is not None
         
-        return cleaned_reply
+        reply = _submit(
+            "reply",
+            _assemble_reply_ids(messages),
+            _adaptive_generation_kwargs(_REPLY_GENERATION_KWARGS),
+            deadline=deadline,
+        )
+
+        reply, from_model = _finalize_reply(reply)
+        _remember_reply(cache_key, reply, from_model)
+        return reply
+
+    except _DeadlineExceeded:
+        _record_budget("fallback")
+        return random.choice(_REPLY_FALLBACKS)
 
     except Exception as e:
         print(f"❌ Ошибка генерации: {e}")
         return "Мяу! Что-то пошло не так... Попробуй ещё раз! 😺"
 
 
-def _build_title_prompt(first_message: str) -> str:
-    system_prompt = (
-        "Ты — эксперт по созданию названий чатов для космического кота Космокота. "
-        "Создай креативное, короткое название на основе первого сообщения пользователя. "
-        "Название должно быть забавным, включать кошачьи или космические эмодзи и отражать тему. "
-        "Оставайся в теме Космокота.\n\n"
-        "Примеры:\n"
-        "Сообщение: Привет, как дела?\n"
-        "Название чата: Привет от Космокота! 😺🚀\n\n"
-        "Сообщение: Расскажи о космосе.\n"
-        "Название чата: Космические тайны с котиком 🐱🌌\n\n"
-        "Сообщение: Что ты любишь?\n"
-        "Название чата: Любимки Космокота 🥛📦\n\n"
-        f"Сообщение: {first_message}\n"
-        "Название чата:"
-    )
-    return system_prompt
+class _CancelCriteria:
+    """
+    Останавливает generate(), когда потребитель стрима больше не ждёт токены.
+    Тот же протокол, что у transformers.StoppingCriteria.
+    """
 
+    def __init__(self, cancel_event: threading.Event) -> None:
+        self.cancel_event = cancel_event
 
-def generate_chat_title(first_message: str) -> str:
+    def __call__(self, input_ids, scores, **kwargs):
+        done = self.cancel_event.is_set()
+        return torch.full((input_ids.shape[0],), done, dtype=torch.bool, device=input_ids.device)
+
+
+def stream_reply(messages: List[Dict[str, str]], deadline: Optional[float] = None) -> Iterator[Dict[str, str]]:
     """
-    Генерирует креативное название для чата на основе первого сообщения.
+    Генерирует ответ Космокота по токенам.
+
+    Отдаёт события {"type": "token", "text": ...} по мере декодирования и
+    последним — {"type": "done", "reply": ...} с очищенным ответом, который
+    нужно сохранить в историю. Текст после стоп-фраз не отдаётся, а генерация
+    прерывается сразу, как только стоп-фраза появилась. deadline — как у generate_reply.
     """
-    if not _ensure_loaded():
-        # Fallback titles when AI is not available
-        fallback_titles = [
-            "Чат с Космокотом 🐱",
-            "Космические беседы 🚀",
-            "Мяу-диалоги 💫",
-            "Кот в космосе 🌙",
-            "Звёздный кот 🐾",
-            "Космокот онлайн 🛰️",
-            "Галактический чат 🌌",
-            "Котик в скафандре 👨‍🚀"
-        ]
-        return random.choice(fallback_titles)
+    if _inference_mode() == "server":
+        import inference_server
+        return inference_server.stream_reply(messages, deadline)
+    return _stream_reply_local(messages, deadline or reply_deadline())
+
+
+def _stream_reply_local(messages: List[Dict[str, str]], deadline: Optional[float]) -> Iterator[Dict[str, str]]:
+    cache_key, cached = _cached_reply(messages)
+    if cached is not None:
+        yield {"type": "token", "text": cached}
+        yield {"type": "done", "reply": cached}
+        return
+    if _deadline_passed(deadline):
+        _record_budget("expired_before_start")
+        reply = random.choice(_REPLY_FALLBACKS)
+        yield {"type": "token", "text": reply}
+        yield {"type": "done", "reply": reply}
+        return
+    with _lifecycle.in_use():
+        yield from _stream_reply_model(messages, cache_key, deadline)
+
+
+def _stream_reply_model(messages: List[Dict[str, str]], cache_key: Optional[str],
+                        deadline: Optional[float]) -> Iterator[Dict[str, str]]:
+    if not _ensure_loaded(_load_wait(deadline)):
+        reply = random.choice(_REPLY_FALLBACKS)
+        yield {"type": "token", "text": reply}
+        yield {"type": "done", "reply": reply}
+        return
+
+    cancel_event = threading.Event()
+    raw = ""
+    sent = 0
 
     try:
         assert _tokenizer is not None and _model is not None
-        prompt = _build_title_prompt(first_message)
-
-        inputs = _tokenizer(
-            prompt,
-            return_tensors="pt",
-            padding=False,
-            truncation=True,
-            max_length=256  # Увеличили немного
+
+        streamer = TextIteratorStreamer(
+            _tokenizer,
+            skip_prompt=True,
+            skip_special_tokens=True,
+            timeout=STREAM_TOKEN_TIMEOUT,
         )
+        # Генерация идёт на свободной реплике планировщика, а мы читаем токены из стримера
+        item = _scheduler.enqueue(GenerationRequest(
+            "reply",
+            _assemble_reply_ids(messages),
+            _adaptive_generation_kwargs(_REPLY_GENERATION_KWARGS),
+            streamer=streamer,
+            extra_criteria=[_CancelCriteria(cancel_event)],
+            deadline=deadline,
+        ))
+
+        for chunk in streamer:
+            raw += chunk
+            visible, stopped = _cut_at_stop_phrase(raw.lstrip())
+            if stopped:
+                cancel_event.set()
+            else:
+                # Придерживаем хвост, который может оказаться началом стоп-фразы
+                visible = visible[:len(visible) - _stop_phrase_holdback(visible)]
+            if len(visible) > sent:
+                yield {"type": "token", "text": visible[sent:]}
+                sent = len(visible)
+            if stopped:
+                break
 
-        device = next(_model.parameters()).device
-        input_ids = inputs.input_ids.to(device)
-        attention_mask = inputs.attention_mask.to(device) if inputs.attention_mask is not None else None
+        # Признак дедлайна выставляется после generate(), чуть позже конца стрима
+        item.done.wait(STREAM_TOKEN_TIMEOUT)
+        if item.error is not None:
+            raise item.error
 
-        with torch.no_grad():
-            outputs = _model.generate(
-                input_ids,
-                attention_mask=attention_mask,
-                max_new_tokens=30,  # Увеличили для лучших названий
-                temperature=0.7,
-                do_sample=True,
-                pad_token_id=_tokenizer.pad_token_id,
-                eos_token_id=_tokenizer.eos_token_id,
-                repetition_penalty=1.2,
-                no_repeat_ngram_size=2,
-                top_p=0.9,
-                top_k=40,
-            )
+        if item.deadline_hit and not _reply_is_complete(raw.strip()):
+            # Уже отданный частичный текст клиент заменит заглушкой
+            _record_budget("fallback")
+            yield {"type": "done", "reply": random.choice(_REPLY_FALLBACKS)}
+            return
+
+        reply, from_model = _finalize_reply(raw.strip())
+        _remember_reply(cache_key, reply, from_model)
+        yield {"type": "done", "reply": reply}
+
+    except Exception as e:
+        print(f"❌ Ошибка потоковой генерации: {e}")
+        yield {"type": "done", "reply": "Мяу! Что-то пошло не так... Попробуй ещё раз! 😺"}
+    finally:
+        cancel_event.set()
+
+
+_TITLE_PROMPT_PREFIX = (
+    "Ты — эксперт по созданию названий чатов для космического кота Космокота. "
+    "Создай креативное, короткое название на основе первого сообщения пользователя. "
+    "Название должно быть забавным, включать кошачьи или космические эмодзи и отражать тему. "
+    "Оставайся в теме Космокота.\n\n"
+    "Примеры:\n"
+    "Сообщение: Привет, как дела?\n"
+    "Название чата: Привет от Космокота! 😺🚀\n\n"
+    "Сообщение: Расскажи о космосе.\n"
+    "Название чата: Космические тайны с котиком 🐱🌌\n\n"
+    "Сообщение: Что ты любишь?\n"
+    "Название чата: Любимки Космокота 🥛📦"
+)
+
+
+def _assemble_title_ids(first_message: str) -> List[int]:
+    """Изменяемая часть промпта названия в токенах; первое сообщение обрезается справа."""
+    # Префикс заканчивается не пробельным символом, поэтому граница токенов не плывёт
+    header = _tokenize_cached("\n\nСообщение:")
+    body = _tokenize_cached(f" {first_message.strip()}")[:TITLE_MESSAGE_TOKENS]
+    return header + body + _tokenize_cached("\nНазвание чата:")
 
-        # Декодируем только новые токены
-        new_tokens = outputs[0][input_ids.shape[1]:]
-        title = _tokenizer.decode(new_tokens, skip_special_tokens=True).strip()
+
+# Параметры генерации названия чата
+_TITLE_GENERATION_KWARGS: Dict[str, Any] = dict(
+    max_new_tokens=30,  # Увеличили для лучших названий
+    temperature=0.7,
+    do_sample=True,
+    repetition_penalty=1.2,
+    no_repeat_ngram_size=2,
+    top_p=0.9,
+    top_k=40,
+)
+
+
+# Fallback titles when AI is not available
+_TITLE_FALLBACKS = [
+    "Чат с Космокотом 🐱",
+    "Космические беседы 🚀",
+    "Мяу-диалоги 💫",
+    "Кот в космосе 🌙",
+    "Звёздный кот 🐾",
+    "Космокот онлайн 🛰️",
+    "Галактический чат 🌌",
+    "Котик в скафандре 👨‍🚀"
+]
+
+
+def generate_chat_title(first_message: str) -> str:
+    """
+    Генерирует креативное название для чата на основе первого сообщения.
+    """
+    if _inference_mode() == "server":
+        import inference_server
+        return inference_server.generate_chat_title(first_message)
+    return _generate_chat_title_local(first_message)
+
+
+def _generate_chat_title_local(first_message: str) -> str:
+    with _lifecycle.in_use():
+        return _generate_chat_title_model(first_message)
+
+
+def _generate_chat_title_model(first_message: str) -> str:
+    if not _ensure_loaded(MODEL_LOAD_WAIT):
+        return random.choice(_TITLE_FALLBACKS)
+
+    try:
+        assert _tokenizer is not None and _model is not None
+        title = _submit("title", _assemble_title_ids(first_message), _TITLE_GENERATION_KWARGS)
 
         # Очистка названия
         title = re.split(r'[.!?\n]', title)[0].strip()
-        title = title[:50]
+        title = title[:TITLE_MAX_CHARS]
         
         # Добавляем эмодзи если его нет
         if not re.search(r'[\U0001F300-\U0001F6FF\U0001F900-\U0001F9FF]', title):
@@ -361,26 +1340,9 @@ def generate_chat_title(first_message: str) -> str:
 
 def get_random_cat() -> str:
     """Возвращает URL случайного кота с aleatori.cat"""
-    try:
-        url = "https://aleatori.cat/random.json"
-        resp = requests.get(url, timeout=5)
-        resp.raise_for_status()
-        data = resp.json()
-        
-        # Из ответа берем поле "url" с JPEG изображением
-        cat_url = data.get("url")
-        if cat_url:
-            return cat_url
-        else:
-            print("❌ Не удалось получить URL кота из ответа")
-            return "https://aleatori.cat/cat"  # fallback URL
-            
-    except requests.exceptions.Timeout:
-        print("❌ Таймаут при запросе к aleatori.cat")
-        return "https://aleatori.cat/cat"
-    except requests.exceptions.RequestException as e:
-        print(f"❌ Ошибка сети при запросе к aleatori.cat: {e}")
-        return "https://aleatori.cat/cat"
-    except Exception as e:
-        print(f"❌ Неожиданная ошибка при получении кота: {e}")
-        return "https://aleatori.cat/cat"
\ No newline at end of file
+    import cat_client
+    cat_url = cat_client.random_cat_url()
+    if cat_url:
+        return cat_url
+    print("❌ Не удалось получить URL кота")
+    return f"{cat_client.CAT_API_URL}/cat"  # fallback URL
@@ -1,22 +1,39 @@
 from __future__ import annotations
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, Response, send_file
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, Response, send_file, stream_with_context
 from flask_login import LoginManager, login_required, current_user
+from typing import Optional
 import os
+import json
+import hmac
 
 import auth_manager
 import db_manager
 import ai_core
+import cat_client
 import profile_manager
 import chat_manager
+import job_manager
 
+# Токен сборщика метрик: /api/metrics с заголовком "Authorization: Bearer <токен>".
+# Без токена метрики видны только вошедшим пользователям
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
 
-def create_app() -> Flask:
+
+def create_app(preload_model: bool = True, start_background: bool = True) -> Flask:
     app = Flask(__name__)
     app.secret_key = os.environ.get("SECRET_KEY", "dev-secret-key-change-me")
 
     # Init DB
     db_manager.init_db()
 
+    # Загружаем модель в фоне, чтобы первое сообщение не ждало её
+    if preload_model and os.environ.get("MODEL_PRELOAD", "1") != "0":
+        ai_core.preload_async()
+
+    # Аватары для новых чатов готовятся заранее, в фоне
+    if start_background:
+        chat_manager.start_avatar_pool()
+
     # Flask-Login setup
     login_manager = LoginManager(app)
     login_manager.login_view = "login"
@@ -131,8 +148,23 @@ def create_app() -> Flask:
     @app.route("/platform")
     @login_required
     def platform():
-        chats = chat_manager.list_chats(int(current_user.id))
-        return render_template("platform.html", chats=chats)
+        # Только первая страница: остальные чаты подгружаются при прокрутке через /api/chats
+        chats, next_cursor = _chats_page(int(current_user.id), None, chat_manager.CHATS_PAGE_SIZE)
+        return render_template("platform.html", chats=chats, next_cursor=next_cursor)
+
+    @app.route("/api/chats", methods=["GET"])
+    @login_required
+    def api_chats():
+        """Следующая страница списка чатов: ?before=<next_cursor>&limit=<n>"""
+        before = request.args.get('before', None, type=int)
+        limit = request.args.get('limit', chat_manager.CHATS_PAGE_SIZE, type=int)
+        limit = max(1, min(limit, chat_manager.CHATS_PAGE_MAX))
+        chats, next_cursor = _chats_page(int(current_user.id), before, limit)
+        for chat in chats:
+            chat["url"] = url_for("chat", chat_id=chat["chat_id"])
+            chat["icon_url"] = (url_for("chat_icon", chat_id=chat["chat_id"], v=chat["icon_hash"])
+                                if chat["icon_hash"] else None)
+        return jsonify({"chats": chats, "next_cursor": next_cursor})
 
     @app.route("/chat/new", methods=["POST"])
     @login_required
@@ -149,14 +181,14 @@ def create_app() -> Flask:
             flash("Чат не найден", "error")
             return redirect(url_for("platform"))
         
-        history = chat_manager.get_chat_history(chat_id)
+        history = chat_manager.get_chat_history(chat_id, limit=chat_manager.HISTORY_PAGE_SIZE)
         chat_info = chat_manager.get_chat_info(chat_id)
         return render_template("chat.html", chat_id=chat_id, history=history, chat_info=chat_info)
 
     @app.route("/api/send_message", methods=["POST"])
     @login_required
     def api_send_message():
-        """API endpoint для асинхронной отправки сообщений"""
+        """Синхронная отправка сообщения (для совместимости): ждёт готовый ответ"""
         data = request.get_json()
         chat_id = data.get('chat_id')
         message = data.get('message', '').strip()
@@ -168,30 +200,138 @@ def create_app() -> Flask:
         if not _check_chat_access(chat_id, int(current_user.id)):
             return jsonify({'error': 'Чат не найден'}), 404
         
-        # Добавляем сообщение пользователя
-        chat_manager.append_message(chat_id, 'user', message)
-        
-        # Генерируем ответ ИИ
-        history = chat_manager.get_chat_history(chat_id)
+        # Ответ генерируется в пуле генерации, запрос только ждёт его
+        user_id = int(current_user.id)
         try:
-            reply = ai_core.generate_reply(history)
-        except Exception as e:
-            print(f"❌ Ошибка генерации ответа: {e}")
-            reply = "Мяу... Похоже, мои двигатели перегрелись. Попробуйте ещё раз."
-        
-        # Добавляем ответ ассистента
-        chat_manager.append_message(chat_id, 'assistant', reply)
+            job_id = job_manager.submit_turn(chat_id, user_id, message)
+        except job_manager.QueueFull as e:
+            return _queue_full_response(e)
+        job = job_manager.wait_job(job_id, user_id, timeout=job_manager.MAX_POLL_WAIT)
+        while job is not None and job['status'] != 'done':
+            job = job_manager.wait_job(job_id, user_id, offset=len(job['text']), timeout=job_manager.MAX_POLL_WAIT)
+        reply = job['reply'] if job else "Мяу... Похоже, мои двигатели перегрелись. Попробуйте ещё раз."
         
         return jsonify({'reply': reply})
 
+    @app.route("/api/jobs", methods=["POST"])
+    @login_required
+    def api_submit_job():
+        """Ставит ход в очередь генерации и сразу возвращает job_id"""
+        data = request.get_json()
+        chat_id = data.get('chat_id')
+        message = data.get('message', '').strip()
+
+        if not chat_id or not message:
+            return jsonify({'error': 'Неверные данные'}), 400
+
+        # Проверяем доступ к чату
+        if not _check_chat_access(chat_id, int(current_user.id)):
+            return jsonify({'error': 'Чат не найден'}), 404
+
+        try:
+            job_id = job_manager.submit_turn(chat_id, int(current_user.id), message)
+        except job_manager.QueueFull as e:
+            return _queue_full_response(e)
+        return jsonify({'job_id': job_id}), 202
+
+    @app.route("/api/jobs/<string:job_id>", methods=["GET"])
+    @login_required
+    def api_job(job_id: str):
+        """
+        Состояние генерации ответа. С параметром wait (секунды) ждёт, пока текст
+        не станет длиннее offset символов или ответ не будет готов (long-poll).
+        """
+        offset = request.args.get('offset', 0, type=int)
+        wait = request.args.get('wait', 0.0, type=float)
+        job = job_manager.wait_job(job_id, int(current_user.id), offset=offset, timeout=wait)
+        if job is None:
+            return jsonify({'error': 'Задача не найдена'}), 404
+        return jsonify(job)
+
+    @app.route("/api/send_message/stream", methods=["POST"])
+    @login_required
+    def api_send_message_stream():
+        """API endpoint для потоковой отправки сообщений (Server-Sent Events)"""
+        data = request.get_json()
+        chat_id = data.get('chat_id')
+        message = data.get('message', '').strip()
+
+        if not chat_id or not message:
+            return jsonify({'error': 'Неверные данные'}), 400
+
+        # Проверяем доступ к чату
+        if not _check_chat_access(chat_id, int(current_user.id)):
+            return jsonify({'error': 'Чат не найден'}), 404
+
+        user_id = int(current_user.id)
+        try:
+            job_id = job_manager.submit_turn(chat_id, user_id, message)
+        except job_manager.QueueFull as e:
+            return _queue_full_response(e)
+
+        def _events():
+            # Пересылаем текст задачи по мере генерации
+            offset = 0
+            finished = False
+            try:
+                while True:
+                    job = job_manager.wait_job(job_id, user_id, offset=offset, timeout=job_manager.MAX_POLL_WAIT)
+                    if job is None:
+                        reply = "Мяу... Похоже, мои двигатели перегрелись. Попробуйте ещё раз."
+                        yield f"data: {json.dumps({'type': 'done', 'reply': reply}, ensure_ascii=False)}\n\n"
+                        return
+                    if job['status'] == 'done':
+                        finished = True
+                        yield f"data: {json.dumps({'type': 'done', 'reply': job['reply']}, ensure_ascii=False)}\n\n"
+                        return
+                    if len(job['text']) > offset:
+                        yield f"data: {json.dumps({'type': 'token', 'text': job['text'][offset:]}, ensure_ascii=False)}\n\n"
+                        offset = len(job['text'])
+            finally:
+                # Соединение оборвалось до конца ответа — останавливаем модель
+                if not finished:
+                    job_manager.cancel_job(job_id, user_id)
+
+        return Response(
+            stream_with_context(_events()),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    @app.route("/api/chat/<string:chat_id>/title")
+    @login_required
+    def api_chat_title(chat_id: str):
+        """Название чата: pending=true, пока настоящее название генерируется в фоне"""
+        if not _check_chat_access(chat_id, int(current_user.id)):
+            return jsonify({'error': 'Чат не найден'}), 404
+        status = chat_manager.get_chat_title(chat_id)
+        if status is None:
+            return jsonify({'error': 'Чат не найден'}), 404
+        return jsonify(status)
+
+    @app.route("/api/ready")
+    def api_ready():
+        """Готовность модели: 200, когда она загружена (или выгружена по простою), иначе 503"""
+        status = ai_core.model_status()
+        return jsonify(status), (200 if status.get("state") in ("ready", "unloaded") else 503)
+
+    @app.route("/api/metrics")
+    def api_metrics():
+        """Метрики инференса (батчи, задержки) для мониторинга: по METRICS_TOKEN или после входа"""
+        if not _metrics_allowed():
+            return jsonify({'error': 'Нужен вход или токен метрик'}), 401
+        return jsonify(dict(ai_core.get_metrics(), jobs=job_manager.stats(),
+                            avatar_pool=chat_manager.avatar_pool_stats(), cat_service=cat_client.stats()))
+
     @app.route("/user/<int:user_id>/avatar")
     def user_avatar(user_id: int):
         """Получить аватар пользователя"""
-        avatar_blob = profile_manager.get_user_avatar(user_id)
-        if not avatar_blob:
+        response = _cached_image(profile_manager.get_user_avatar_hash(user_id),
+                                 lambda: profile_manager.get_user_avatar(user_id))
+        if response is None:
             # Вернуть дефолтный аватар из assets через отдельный маршрут
             return redirect(url_for('default_avatar'))
-        return Response(avatar_blob, mimetype="image/png")
+        return response
 
     @app.route("/assets/<path:filename>")
     def assets(filename):
@@ -210,37 +350,81 @@ def create_app() -> Flask:
     @app.route("/chat/<string:chat_id>/avatar")
     def chat_avatar(chat_id: str):
         """Получить аватар чата"""
-        cat_avatar_blob = chat_manager.get_chat_avatar(chat_id)
-        if not cat_avatar_blob:
-            # Генерируем новый аватар
-            cat_avatar_blob = _generate_chat_avatar(chat_id)
-            
+        hashes = chat_manager.get_chat_image_hashes(chat_id)
+        if hashes and hashes["avatar"]:
+            response = _cached_image(hashes["avatar"], lambda: chat_manager.get_chat_avatar(chat_id))
+            if response is not None:
+                return response
+
+        # Аватар берётся из пула или генерируется в фоне и сохраняется в чат
+        cat_avatar_blob = chat_manager.request_chat_avatar(chat_id) if hashes else None
         if not cat_avatar_blob:
-            return "", 204
+            # Пока аватар готовится — аватар по умолчанию
+            return redirect(url_for('default_avatar'))
             
         return Response(cat_avatar_blob, mimetype="image/png")
 
+    @app.route("/chat/<string:chat_id>/icon")
+    def chat_icon(chat_id: str):
+        """Получить иконку чата (64x64)"""
+        hashes = chat_manager.get_chat_image_hashes(chat_id)
+        response = _cached_image(hashes["icon"], lambda: chat_manager.get_chat_icon(chat_id)) if hashes else None
+        if response is None:
+            return redirect(url_for('default_avatar'))
+        return response
+
+    def _cached_image(content_hash: Optional[str], load_blob) -> Optional[Response]:
+        """
+        PNG с ETag по хэшу содержимого. Если браузер прислал тот же ETag —
+        304 без загрузки картинки из базы. URL с ?v=<хэш> неизменяем и
+        кэшируется на год, без версии — каждый раз перепроверяется.
+        """
+        if not content_hash:
+            return None
+        if request.if_none_match.contains(content_hash):
+            response = Response(status=304)
+        else:
+            blob = load_blob()
+            if not blob:
+                return None
+            response = Response(blob, mimetype="image/png")
+        response.set_etag(content_hash)
+        if request.args.get("v") == content_hash:
+            response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        else:
+            response.headers["Cache-Control"] = "no-cache"
+        return response
+
+    def _queue_full_response(e: Exception):
+        """429 с Retry-After, когда очередь генерации заполнена"""
+        response = jsonify({'error': 'Космокот занят, попробуйте чуть позже', 'retry_after': e.retry_after})
+        response.status_code = 429
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response
+
+    def _chats_page(user_id: int, before: Optional[int], limit: int):
+        """Страница чатов и cursor следующей (None — это последняя страница)"""
+        chats = chat_manager.list_chats(user_id, before=before, limit=limit)
+        next_cursor = chats[-1]["cursor"] if len(chats) == limit else None
+        return chats, next_cursor
+
+    def _metrics_allowed() -> bool:
+        """Метрики раскрывают нагрузку и очереди, поэтому открыты не всем"""
+        if METRICS_TOKEN:
+            auth = request.headers.get("Authorization", "")
+            if hmac.compare_digest(auth.encode("utf-8"), f"Bearer {METRICS_TOKEN}".encode("utf-8")):
+                return True
+        return current_user.is_authenticated
+
     def _check_chat_access(chat_id: str, user_id: int) -> bool:
         """Проверяет принадлежит ли чат пользователю"""
-        user_chats = chat_manager.list_chats(user_id)
-        return any(chat['chat_id'] == chat_id for chat in user_chats)
-
-    def _generate_chat_avatar(chat_id: str) -> bytes:
-        """Генерирует аватар для чата используя aleatori.cat"""
-        try:
-            import requests
-            url = ai_core.get_random_cat()
-            if url:
-                response = requests.get(url, timeout=10)
-                if response.status_code == 200:
-                    return chat_manager.process_avatar(response.content, 500)
-        except Exception as e:
-            print(f"❌ Ошибка генерации аватара чата: {e}")
-        return None
+        return chat_manager.user_owns_chat(chat_id, user_id)
 
 
     return app
 
 if __name__ == "__main__":
-    app = create_app()
+    # Перезагрузчик Werkzeug запускает этот файл дважды; модель и фоновые потоки нужны только рабочему процессу
+    serving = os.environ.get("WERKZEUG_RUN_MAIN") == "true"
+    app = create_app(preload_model=serving, start_background=serving)
     app.run(host="0.0.0.0", port=5000, debug=True)
\ No newline at end of file
@@ -5,13 +5,15 @@ from werkzeug.security import generate_password_hash, check_password_hash
 import db_manager
 
 class AuthUser(UserMixin):
-    def __init__(self, user_id: int, login: str, name: Optional[str] = None) -> None:
+    def __init__(self, user_id: int, login: str, name: Optional[str] = None, avatar_hash: Optional[str] = None) -> None:
         self.id = str(user_id)
         self.login = login
         self.name = name or ""
+        # Версия аватара для URL с долгим кэшированием
+        self.avatar_hash = avatar_hash
 
 def _to_auth_user(u: db_manager.User) -> AuthUser:
-    return AuthUser(user_id=u.id, login=u.login, name=u.name)
+    return AuthUser(user_id=u.id, login=u.login, name=u.name, avatar_hash=u.avatar_hash)
 
 def register_user(login: str, password: str, name: Optional[str] = None) -> bool:
     with db_manager.get_session() as session:
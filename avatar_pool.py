@@ -0,0 +1,196 @@
+"""Pool of pre-fetched, pre-cropped cat avatars for new chats."""
+
+from __future__ import annotations
+from typing import Callable, Dict, List, Optional, Tuple, Any
+from collections import deque
+import os
+import threading
+import time
+import uuid
+
+# Пара картинок чата: (аватар 500x500, иконка 64x64), обе PNG
+AvatarPair = Tuple[bytes, bytes]
+
+
+class AvatarPool:
+    """
+    Держит наготове size пар аватар/иконка, чтобы создание чата не ходило
+    в сеть и не обрабатывало картинки. Фоновый поток пополняет пул через
+    producer; сверх size до spill_size пар складывается на диск (spill_dir)
+    и переживает перезапуск процесса.
+    """
+
+    def __init__(self, producer: Callable[[], Optional[AvatarPair]], size: int,
+                 spill_dir: Optional[str] = None, spill_size: int = 0,
+                 name: str = "cosmocat-avatar-pool") -> None:
+        self.producer = producer
+        self.size = max(0, size)
+        self.spill_dir = spill_dir if spill_size > 0 else None
+        self.spill_size = spill_size
+        self._name = name
+        self._memory: deque = deque()
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._stats = {"popped": 0, "returned": 0, "from_disk": 0, "empty": 0, "produced": 0, "failed": 0}
+
+    def start(self) -> None:
+        """Запускает фоновое пополнение (повторный вызов ничего не делает)."""
+        with self._cond:
+            if self._thread is not None or self.size == 0:
+                return
+            if self.spill_dir and not self._prepare_spill_dir():
+                self.spill_dir = None
+            self._thread = threading.Thread(target=self._refill_loop, name=self._name, daemon=True)
+            self._thread.start()
+
+    def pop(self) -> Optional[AvatarPair]:
+        """Готовая пара или None, если пул пуст — тогда вызывающий берёт аватар по умолчанию."""
+        with self._cond:
+            pair = self._memory.popleft() if self._memory else None
+            if pair is None:
+                pair = self._pop_spilled()
+                if pair is not None:
+                    self._stats["from_disk"] += 1
+            self._stats["popped" if pair is not None else "empty"] += 1
+            self._cond.notify_all()
+        return pair
+
+    def put_back(self, pair: AvatarPair) -> None:
+        """Возвращает неиспользованную пару: её получит следующий pop."""
+        with self._cond:
+            self._memory.appendleft(pair)
+            self._stats["returned"] += 1
+
+    # === Диск ===
+
+    def _prepare_spill_dir(self) -> bool:
+        """
+        Создаёт папку для пар на диске с правами 0700. Картинки из неё отдаются
+        как аватары, поэтому чужая или доступная другим на запись папка не годится.
+        """
+        try:
+            os.makedirs(self.spill_dir, mode=0o700, exist_ok=True)
+            st = os.stat(self.spill_dir)
+        except OSError as e:
+            print(f"⚠️ Аватары не будут сохраняться на диск: {e}")
+            return False
+        if os.name == "posix" and (st.st_uid != os.getuid() or st.st_mode & 0o022):
+            print(f"⚠️ Папка {self.spill_dir} чужая или доступна другим на запись — аватары не сохраняются на диск")
+            return False
+        return True
+
+    def _spilled(self) -> List[str]:
+        """Пути аватаров на диске, старые первыми"""
+        if not self.spill_dir or not os.path.isdir(self.spill_dir):
+            return []
+        stamped = []
+        for name in os.listdir(self.spill_dir):
+            if not name.endswith(".avatar.png"):
+                continue
+            path = os.path.join(self.spill_dir, name)
+            try:
+                stamped.append((os.path.getmtime(path), path))
+            except OSError:
+                # Пару только что забрал другой процесс
+                continue
+        return [path for _, path in sorted(stamped)]
+
+    def _spill(self, pair: AvatarPair) -> None:
+        base = os.path.join(self.spill_dir, uuid.uuid4().hex)
+        # Иконка пишется первой: файл аватара появляется последним и означает готовую пару
+        for suffix, data in ((".icon.png", pair[1]), (".avatar.png", pair[0])):
+            tmp_path = base + suffix + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, base + suffix)
+
+    def _pop_spilled(self) -> Optional[AvatarPair]:
+        """
+        Забирает самую старую пару с диска. Папку могут делить несколько воркеров,
+        поэтому пара сначала переименовывается в имя этого процесса: rename
+        атомарен, и одну пару получит только один из них.
+        """
+        with self._cond:
+            for avatar_path in self._spilled():
+                base = avatar_path[:-len(".avatar.png")]
+                claimed = f"{base}.{os.getpid()}-{uuid.uuid4().hex[:8]}.claimed"
+                try:
+                    os.rename(avatar_path, claimed)
+                except OSError:
+                    # Пару уже забрал другой процесс
+                    continue
+                try:
+                    with open(claimed, "rb") as f:
+                        avatar = f.read()
+                    with open(base + ".icon.png", "rb") as f:
+                        icon = f.read()
+                    return avatar, icon
+                except OSError:
+                    continue
+                finally:
+                    for path in (claimed, base + ".icon.png"):
+                        try:
+                            os.remove(path)
+                        except OSError:
+                            pass
+        return None
+
+    # === Пополнение ===
+
+    def _needs(self) -> Optional[str]:
+        """Куда положить следующую пару: "memory", "disk" или None — всё заполнено"""
+        if len(self._memory) < self.size:
+            return "memory"
+        if self.spill_dir and len(self._spilled()) < self.spill_size:
+            return "disk"
+        return None
+
+    def _refill_loop(self) -> None:
+        backoff = 1.0
+        while True:
+            with self._cond:
+                target = self._needs()
+                while target is None:
+                    self._cond.wait(60)
+                    target = self._needs()
+                # Сначала поднимаем в память то, что уже лежит на диске
+                if target == "memory":
+                    spilled = self._pop_spilled()
+                    if spilled is not None:
+                        self._memory.append(spilled)
+                        continue
+
+            try:
+                pair = self.producer()
+            except Exception as e:
+                print(f"❌ Ошибка подготовки аватара: {e}")
+                pair = None
+            if pair is None:
+                with self._cond:
+                    self._stats["failed"] += 1
+                # Сервис котов недоступен — не долбим его в цикле
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 60.0)
+                continue
+            backoff = 1.0
+
+            with self._cond:
+                self._stats["produced"] += 1
+                target = self._needs()
+                if target == "memory":
+                    self._memory.append(pair)
+                elif target == "disk":
+                    try:
+                        self._spill(pair)
+                    except OSError as e:
+                        print(f"⚠️ Не удалось сохранить аватар на диск: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return dict(
+                self._stats,
+                size=self.size,
+                in_memory=len(self._memory),
+                on_disk=len(self._spilled()),
+                spill_size=self.spill_size if self.spill_dir else 0,
+            )
@@ -0,0 +1,509 @@
+"""Бенчмарки и проверки производительности CosmoCats.
+
+Запуск: python bench.py <команда> [опции]. Команда завершается с кодом 1,
+если проверка не прошла.
+"""
+
+from __future__ import annotations
+from typing import List, Dict
+import argparse
+import base64
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import ai_core
+
+
+_SAMPLE_CONVERSATIONS: List[List[Dict[str, str]]] = [
+    [],
+    [{"role": "user", "content": "Привет!"}],
+    [{"role": "user", "content": "Как дела?"}],
+    [
+        {"role": "user", "content": "Что ты любишь есть?"},
+        {"role": "assistant", "content": "Молоко и космическую рыбку! Мяу! 🥛"},
+        {"role": "user", "content": "А где ты живёшь?"},
+    ],
+]
+
+
+def _require_model() -> None:
+    if not ai_core._ensure_loaded():
+        print("❌ Модель не загружена — бенчмарк невозможен")
+        sys.exit(1)
+
+
+def _prefill(suffix: List[int], cached: bool) -> None:
+    """Обработка промпта ответа до первого нового токена."""
+    input_ids, attention_mask, past = ai_core._encode_batch("reply", [suffix], use_prefix_cache=cached)
+    start = past.get_seq_length() if past is not None else 0
+    with ai_core.torch.no_grad():
+        ai_core._model(input_ids[:, start:], attention_mask=attention_mask, past_key_values=past, use_cache=True)
+
+
+def bench_prefix_cache(args: argparse.Namespace) -> int:
+    """Сравнивает генерацию с KV-кэшем префикса и без него при жадном декодировании."""
+    _require_model()
+    torch = ai_core.torch
+    model = ai_core._model
+    tokenizer = ai_core._tokenizer
+    if "reply" not in ai_core._prefix_caches:
+        print("❌ KV-кэш префикса не построен (PREFIX_CACHE=0 или несовпадение токенов)")
+        return 1
+
+    greedy = dict(
+        max_new_tokens=args.new_tokens,
+        do_sample=False,
+        pad_token_id=tokenizer.pad_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+    )
+    mismatches = 0
+    prefill = {True: 0.0, False: 0.0}
+    for messages in _SAMPLE_CONVERSATIONS:
+        suffix = ai_core._assemble_reply_ids(messages)
+        outputs = {}
+        for cached in (False, True):
+            started = time.perf_counter()
+            for _ in range(args.repeat):
+                _prefill(suffix, cached)
+            prefill[cached] += (time.perf_counter() - started) / args.repeat
+
+            input_ids, attention_mask, past = ai_core._encode_batch("reply", [suffix], use_prefix_cache=cached)
+            with torch.no_grad():
+                out = model.generate(input_ids, attention_mask=attention_mask, past_key_values=past, **greedy)
+            outputs[cached] = out[0, input_ids.shape[1]:].tolist()
+        same = outputs[True] == outputs[False]
+        mismatches += 0 if same else 1
+        text = tokenizer.decode(outputs[True], skip_special_tokens=True).strip()
+        print(f"{'✅' if same else '❌'} {len(messages)} сообщ.: {text[:60]!r}")
+
+    n = len(_SAMPLE_CONVERSATIONS)
+    print(f"Prefill без кэша: {1000 * prefill[False] / n:.1f} мс, с кэшем: {1000 * prefill[True] / n:.1f} мс")
+    return 1 if mismatches else 0
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss в Linux измеряется в килобайтах
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def bench_generation_stats(args: argparse.Namespace) -> int:
+    """Меряет загрузку, скорость генерации и память в текущем режиме модели; печатает JSON."""
+    started = time.perf_counter()
+    _require_model()
+    load_seconds = time.perf_counter() - started
+    torch = ai_core.torch
+    tokenizer = ai_core._tokenizer
+
+    greedy = dict(
+        max_new_tokens=args.new_tokens,
+        do_sample=False,
+        pad_token_id=tokenizer.pad_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+    )
+    generated = 0
+    seconds = 0.0
+    replies = []
+    for messages in _SAMPLE_CONVERSATIONS:
+        input_ids, attention_mask, past = ai_core._encode_batch("reply", [ai_core._assemble_reply_ids(messages)])
+        with torch.no_grad():
+            started = time.perf_counter()
+            out = ai_core._model.generate(input_ids, attention_mask=attention_mask, past_key_values=past, **greedy)
+            seconds += time.perf_counter() - started
+        new_tokens = out[0, input_ids.shape[1]:].tolist()
+        generated += len(new_tokens)
+        replies.append({"tokens": new_tokens, "text": tokenizer.decode(new_tokens, skip_special_tokens=True).strip()})
+
+    print(json.dumps({
+        "mode": ai_core._quantize_mode(),
+        "backend": ai_core._backend,
+        "load_seconds": round(load_seconds, 2),
+        "tokens_per_second": round(generated / seconds, 2) if seconds else None,
+        "peak_rss_mb": round(_peak_rss_mb(), 1),
+        "replies": replies,
+    }, ensure_ascii=False))
+    return 0
+
+
+def _run_generation_stats(env_overrides: Dict[str, str], new_tokens: int) -> Dict:
+    """Запускает generation-stats в отдельном процессе (чистая память и состояние модуля)."""
+    env = dict(os.environ, **env_overrides)
+    proc = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "generation-stats", "--new-tokens", str(new_tokens)],
+        env=env, capture_output=True, text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"{env_overrides} завершился с ошибкой:\n{proc.stdout}{proc.stderr}")
+    # JSON — последняя строка вывода, до неё идут логи загрузки модели
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def _compare_variants(variants: Dict[str, Dict[str, str]], new_tokens: int) -> int:
+    """Печатает скорость, память и совпадение жадных ответов каждого варианта с первым."""
+    try:
+        results = {name: _run_generation_stats(env, new_tokens) for name, env in variants.items()}
+    except RuntimeError as e:
+        print(f"❌ {e}")
+        return 1
+
+    print(f"{'вариант':<8} {'движок':<7} {'загрузка, с':>12} {'токенов/с':>10} {'пик RSS, МБ':>12}")
+    for name, r in results.items():
+        print(f"{name:<8} {r['backend']:<7} {r['load_seconds']:>12} {r['tokens_per_second']:>10} {r['peak_rss_mb']:>12}")
+
+    # Качество: доля совпавших токенов жадного ответа относительно эталона
+    reference_name = next(iter(results))
+    reference = results[reference_name]
+    for name, r in list(results.items())[1:]:
+        matched = total = 0
+        for ref, got in zip(reference["replies"], r["replies"]):
+            total += len(ref["tokens"])
+            matched += sum(1 for a, b in zip(ref["tokens"], got["tokens"]) if a == b)
+            print(f"  {reference_name}: {ref['text'][:70]!r}")
+            print(f"  {name}: {got['text'][:70]!r}")
+        print(f"Совпадение токенов {name} с {reference_name}: {100.0 * matched / max(total, 1):.1f}%")
+    return 0
+
+
+def bench_quantize(args: argparse.Namespace) -> int:
+    """Сравнивает fp32 и int8: скорость, память и совпадение жадных ответов."""
+    return _compare_variants({
+        "fp32": {"INFERENCE_BACKEND": "torch", "MODEL_QUANTIZE": "fp32"},
+        "int8": {"INFERENCE_BACKEND": "torch", "MODEL_QUANTIZE": "int8"},
+    }, args.new_tokens)
+
+
+def bench_backends(args: argparse.Namespace) -> int:
+    """Сравнивает torch и ONNX Runtime на одинаковых жадных ответах."""
+    return _compare_variants({
+        "torch": {"INFERENCE_BACKEND": "torch", "MODEL_QUANTIZE": "fp32"},
+        "onnx": {"INFERENCE_BACKEND": "onnx"},
+    }, args.new_tokens)
+
+
+def _percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def bench_load_stats(args: argparse.Namespace) -> int:
+    """Гоняет generate_reply с заданной конкурентностью; печатает пропускную способность и задержки (JSON)."""
+    _require_model()
+    ai_core.torch.manual_seed(0)
+
+    def _one(i: int) -> float:
+        started = time.perf_counter()
+        ai_core.generate_reply(_SAMPLE_CONVERSATIONS[i % len(_SAMPLE_CONVERSATIONS)])
+        return time.perf_counter() - started
+
+    # Прогрев: первый запуск потоков реплик и кэшей не должен попадать в замер
+    ai_core.generate_reply(_SAMPLE_CONVERSATIONS[1])
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        latencies = list(pool.map(_one, range(args.requests)))
+    elapsed = time.perf_counter() - started
+
+    print(json.dumps({
+        "replicas": ai_core.MODEL_REPLICAS,
+        "threads_per_replica": ai_core._replica_threads(),
+        "throughput_rps": round(args.requests / elapsed, 3),
+        "p50_ms": round(1000 * _percentile(latencies, 0.5), 1),
+        "p95_ms": round(1000 * _percentile(latencies, 0.95), 1),
+    }))
+    return 0
+
+
+def bench_replicas(args: argparse.Namespace) -> int:
+    """Перебирает число реплик × потоков на реплику в пределах заданного числа ядер."""
+    cores = args.cores or len(ai_core._available_cores())
+    configs = []
+    replicas = 1
+    while replicas <= cores:
+        threads = 1
+        while replicas * threads <= cores:
+            configs.append((replicas, threads))
+            threads *= 2
+        replicas *= 2
+
+    print(f"Ядер: {cores}, запросов: {args.requests}, конкурентность: {args.concurrency}")
+    print(f"{'реплик':>7} {'потоков':>8} {'запросов/с':>11} {'p50, мс':>9} {'p95, мс':>9}")
+    for replicas, threads in configs:
+        env = dict(
+            os.environ,
+            INFERENCE_MODE="local",
+            MODEL_REPLICAS=str(replicas),
+            REPLICA_THREADS=str(threads),
+            REPLICA_PIN_CORES="1" if args.pin else "0",
+        )
+        proc = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "load-stats",
+             "--requests", str(args.requests), "--concurrency", str(args.concurrency)],
+            env=env, capture_output=True, text=True,
+        )
+        if proc.returncode != 0:
+            print(f"❌ {replicas}×{threads} завершился с ошибкой:\n{proc.stdout}{proc.stderr}")
+            return 1
+        r = json.loads(proc.stdout.strip().splitlines()[-1])
+        print(f"{replicas:>7} {threads:>8} {r['throughput_rps']:>11} {r['p50_ms']:>9} {r['p95_ms']:>9}")
+    return 0
+
+
+# Модули, которых не должно быть в веб-процессе до первого обращения к модели
+_HEAVY_MODULES = ("torch", "transformers", "optimum", "onnxruntime")
+
+
+def bench_importtime(args: argparse.Namespace) -> int:
+    """Замеряет `python -X importtime -c "import <module>"` и сверяет с бюджетом."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {args.module}"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True,
+    )
+    if proc.returncode != 0:
+        print(f"❌ import {args.module} завершился с ошибкой:\n{proc.stderr}")
+        return 1
+
+    # Строки вида "import time:  self [us] | cumulative | imported package"
+    cumulative_us: Dict[str, int] = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if cumulative.strip().isdigit():
+            cumulative_us.setdefault(name.strip(), int(cumulative))
+
+    total_ms = cumulative_us.get(args.module, 0) / 1000
+    heavy = sorted(name for name in cumulative_us if name.split(".")[0] in _HEAVY_MODULES and "." not in name)
+    slowest = sorted(cumulative_us.items(), key=lambda item: item[1], reverse=True)[1:args.top + 1]
+
+    print(f"import {args.module}: {total_ms:.0f} мс (бюджет {args.budget_ms:.0f} мс)")
+    for name, us in slowest:
+        print(f"  {us / 1000:8.1f} мс  {name}")
+
+    failed = False
+    if heavy:
+        print(f"❌ При импорте подгружаются тяжёлые модули: {', '.join(heavy)}")
+        failed = True
+    if total_ms > args.budget_ms:
+        print(f"❌ Импорт дольше бюджета на {total_ms - args.budget_ms:.0f} мс")
+        failed = True
+    if not failed:
+        print("✅ Импорт укладывается в бюджет")
+    return 1 if failed else 0
+
+
+def _io_read_bytes() -> int:
+    """Сколько байт процесс прочитал через read() (rchar из /proc/self/io, только Linux)"""
+    with open("/proc/self/io") as f:
+        for line in f:
+            if line.startswith("rchar:"):
+                return int(line.split()[1])
+    return 0
+
+
+# Таблицы users и chats в прежнем виде: картинки лежат прямо в строке
+_LEGACY_TABLES = [
+    """CREATE TABLE users (
+        id INTEGER PRIMARY KEY, login VARCHAR(255) NOT NULL UNIQUE, password_hash VARCHAR(255) NOT NULL,
+        name VARCHAR(255), avatar_blob BLOB, avatar_hash VARCHAR(64))""",
+    """CREATE TABLE chats (
+        id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL REFERENCES users (id), chat_id VARCHAR(64) NOT NULL UNIQUE,
+        chat_history BLOB, cat_avatar_blob BLOB, title VARCHAR(255), icon_blob BLOB,
+        cat_avatar_hash VARCHAR(64), icon_hash VARCHAR(64))""",
+]
+
+
+def _legacy_list_chats(user_id: int) -> List[Dict[str, str]]:
+    """list_chats в самом первом виде: все колонки всех чатов и base64 каждой иконки"""
+    import db_manager
+    from sqlalchemy import text
+    with db_manager.get_session() as session:
+        rows = session.execute(text("SELECT * FROM chats WHERE user_id = :u ORDER BY id DESC"), {"u": user_id}).all()
+    return [
+        {"chat_id": r.chat_id, "title": r.title,
+         "icon": base64.b64encode(r.icon_blob).decode("utf-8") if r.icon_blob else None}
+        for r in rows
+    ]
+
+
+def _measure_reads(name: str, fn, repeat: int) -> None:
+    fn()  # прогрев соединения
+    read_before = _io_read_bytes()
+    started = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    elapsed = time.perf_counter() - started
+    read_kb = (_io_read_bytes() - read_before) / 1024 / repeat
+    print(f"{name:<42} {read_kb:>13.1f} {1000 * elapsed / repeat:>9.2f}")
+
+
+def bench_db_reads(args: argparse.Namespace) -> int:
+    """
+    Байты, прочитанные из базы за запрос: список чатов, проверка доступа,
+    304 по хэшу и загрузка пользователя — пока картинки лежат в строках
+    users/chats и после их переноса миграцией в user_avatars/chat_images.
+    """
+    if not os.path.exists("/proc/self/io"):
+        print("❌ Нужен Linux: байты чтения берутся из /proc/self/io")
+        return 1
+    import db_manager
+    import chat_manager
+    import auth_manager
+    from sqlalchemy import create_engine, text
+    from sqlalchemy.orm import sessionmaker
+    from sqlalchemy.pool import NullPool
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Новое соединение на каждую сессию: кэш страниц SQLite не прячет чтения
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}", future=True, poolclass=NullPool)
+        with engine.begin() as conn:
+            for ddl in _LEGACY_TABLES:
+                conn.execute(text(ddl))
+            avatar = os.urandom(args.avatar_kb * 1024)
+            user_id = conn.execute(
+                text("INSERT INTO users (login, password_hash, avatar_blob, avatar_hash) VALUES ('bench', '-', :a, :h)"),
+                {"a": avatar, "h": db_manager.content_hash(avatar)},
+            ).lastrowid
+            for i in range(args.chats):
+                avatar, icon = os.urandom(args.avatar_kb * 1024), os.urandom(4 * 1024)
+                conn.execute(
+                    text("INSERT INTO chats (user_id, chat_id, cat_avatar_blob, title, icon_blob, cat_avatar_hash, icon_hash) "
+                         "VALUES (:u, :c, :a, :t, :i, :ah, :ih)"),
+                    {"u": user_id, "c": f"bench{i:011d}", "a": avatar, "t": f"Чат {i}", "i": icon,
+                     "ah": db_manager.content_hash(avatar), "ih": db_manager.content_hash(icon)},
+                )
+        # Остальные таблицы создаются как обычно, миграция пока не запускается
+        db_manager.Base.metadata.create_all(engine)
+        db_manager._engine = engine
+        db_manager.SessionLocal = sessionmaker(bind=engine, autoflush=False, expire_on_commit=False, future=True)
+        target = f"bench{args.chats // 2:011d}"
+
+        scenarios = [
+            ("список чатов", lambda: chat_manager.list_chats(user_id)),
+            ("проверка доступа", lambda: chat_manager.user_owns_chat(target, user_id)),
+            ("304 аватара чата", lambda: chat_manager.get_chat_image_hashes(target)),
+            ("загрузка пользователя", lambda: auth_manager.get_user_by_id(user_id)),
+        ]
+        print(f"Чатов: {args.chats}, аватар: {args.avatar_kb} КБ, повторов: {args.repeat}")
+        print(f"{'запрос':<42} {'КБ за запрос':>13} {'мс':>9}")
+        _measure_reads("список чатов, полная загрузка", lambda: _legacy_list_chats(user_id), args.repeat)
+        for name, fn in scenarios:
+            _measure_reads(f"{name}, картинки в строке", fn, args.repeat)
+
+        db_manager._migrate(engine)
+        for name, fn in scenarios:
+            _measure_reads(f"{name}, отдельно", fn, args.repeat)
+    return 0
+
+
+def bench_db_turns(args: argparse.Namespace) -> int:
+    """Запросы к базе и транзакции на один ход: отдельные вызовы против begin_turn/finish_turn."""
+    import db_manager
+    import chat_manager
+    from sqlalchemy import event
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_manager.init_db(f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        with db_manager.get_session() as session:
+            user = db_manager.User(login="bench", password_hash="-")
+            session.add(user)
+            session.flush()
+            user_id = user.id
+            for chat_id in ("benchseparate", "benchturn"):
+                session.add(db_manager.Chat(user_id=user_id, chat_id=chat_id, title="Чат"))
+                # Уже начатый чат: первый ход не запускает генерацию названия
+                for seq in range(args.history):
+                    session.add(db_manager.Message(
+                        chat_id=chat_id, seq=seq, role="user" if seq % 2 == 0 else "assistant", content="Мяу! " * 20,
+                    ))
+
+        def separate() -> None:
+            chat_manager.user_owns_chat("benchseparate", user_id)
+            chat_manager.append_message("benchseparate", "user", "Привет!")
+            chat_manager.get_chat_history("benchseparate", limit=chat_manager.CONTEXT_MESSAGES)
+            chat_manager.append_message("benchseparate", "assistant", "Мяу!")
+
+        def turn() -> None:
+            # Проверка доступа остаётся в маршруте, чтобы сразу ответить 404
+            chat_manager.user_owns_chat("benchturn", user_id)
+            user_seq, _ = chat_manager.begin_turn("benchturn", user_id, "Привет!")
+            chat_manager.finish_turn("benchturn", user_seq, "Мяу!")
+
+        counts = {"statements": 0, "commits": 0}
+        engine = db_manager._engine
+        event.listen(engine, "before_cursor_execute", lambda *a: counts.__setitem__("statements", counts["statements"] + 1))
+        event.listen(engine, "commit", lambda *a: counts.__setitem__("commits", counts["commits"] + 1))
+
+        print(f"Сообщений в чате: {args.history}, ходов: {args.repeat}")
+        print(f"{'ход':<22} {'запросов':>9} {'транзакций':>11} {'мс':>9}")
+        for name, fn in (("отдельные вызовы", separate), ("begin/finish_turn", turn)):
+            counts.update(statements=0, commits=0)
+            started = time.perf_counter()
+            for _ in range(args.repeat):
+                fn()
+            elapsed = time.perf_counter() - started
+            print(f"{name:<22} {counts['statements'] / args.repeat:>9.1f} "
+                  f"{counts['commits'] / args.repeat:>11.1f} {1000 * elapsed / args.repeat:>9.2f}")
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("prefix-cache", help="KV-кэш префикса: совпадение ответов и время prefill")
+    p.add_argument("--new-tokens", type=int, default=30)
+    p.add_argument("--repeat", type=int, default=5)
+    p.set_defaults(func=bench_prefix_cache)
+
+    p = commands.add_parser("quantize", help="fp32 против int8: токены/с, память, качество ответов")
+    p.add_argument("--new-tokens", type=int, default=40)
+    p.set_defaults(func=bench_quantize)
+
+    p = commands.add_parser("backends", help="torch против ONNX Runtime: токены/с, память, качество ответов")
+    p.add_argument("--new-tokens", type=int, default=40)
+    p.set_defaults(func=bench_backends)
+
+    p = commands.add_parser("replicas", help="реплики × потоки на реплику: пропускная способность и задержки")
+    p.add_argument("--cores", type=int, default=0, help="сколько ядер отдать инференсу (по умолчанию все доступные)")
+    p.add_argument("--requests", type=int, default=32)
+    p.add_argument("--concurrency", type=int, default=8)
+    p.add_argument("--pin", action="store_true", help="закрепить реплики за ядрами")
+    p.set_defaults(func=bench_replicas)
+
+    p = commands.add_parser("load-stats", help="нагрузочный замер текущей конфигурации (JSON; используется replicas)")
+    p.add_argument("--requests", type=int, default=32)
+    p.add_argument("--concurrency", type=int, default=8)
+    p.set_defaults(func=bench_load_stats)
+
+    p = commands.add_parser("generation-stats", help="замер текущего режима модели (JSON; используется quantize/backends)")
+    p.add_argument("--new-tokens", type=int, default=40)
+    p.set_defaults(func=bench_generation_stats)
+
+    p = commands.add_parser("db-reads", help="байты, прочитанные из базы: список чатов и проверка доступа")
+    p.add_argument("--chats", type=int, default=300)
+    p.add_argument("--avatar-kb", type=int, default=150)
+    p.add_argument("--repeat", type=int, default=5)
+    p.set_defaults(func=bench_db_reads)
+
+    p = commands.add_parser("db-turns", help="запросы к базе и транзакции на один ход чата")
+    p.add_argument("--history", type=int, default=20, help="сообщений в чате до замера")
+    p.add_argument("--repeat", type=int, default=50)
+    p.set_defaults(func=bench_db_turns)
+
+    p = commands.add_parser("importtime", help="время импорта веб-приложения и отсутствие torch/transformers")
+    p.add_argument("--module", default="app")
+    p.add_argument("--budget-ms", type=float, default=float(os.environ.get("IMPORT_BUDGET_MS", "1500")))
+    p.add_argument("--top", type=int, default=10, help="сколько самых медленных модулей показать")
+    p.set_defaults(func=bench_importtime)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
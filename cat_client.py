@@ -0,0 +1,193 @@
+"""Shared HTTP client for the random cat image service."""
+
+from __future__ import annotations
+from typing import Dict, Optional, Any
+from collections import deque
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Адрес сервиса котов (локальная заглушка — fake_cat_service.py)
+CAT_API_URL = os.environ.get("CAT_API_URL", "https://aleatori.cat").rstrip("/")
+# Таймауты соединения и чтения, секунды
+CAT_CONNECT_TIMEOUT = float(os.environ.get("CAT_CONNECT_TIMEOUT", "2"))
+CAT_READ_TIMEOUT = float(os.environ.get("CAT_READ_TIMEOUT", "5"))
+# Сколько запросов к сервису одновременно; остальные ждут не дольше CAT_QUEUE_TIMEOUT
+CAT_MAX_CONCURRENCY = int(os.environ.get("CAT_MAX_CONCURRENCY", "4"))
+CAT_QUEUE_TIMEOUT = float(os.environ.get("CAT_QUEUE_TIMEOUT", "1"))
+# Повторы при сетевых ошибках и ответах 5xx
+CAT_RETRIES = int(os.environ.get("CAT_RETRIES", "2"))
+CAT_RETRY_BASE = float(os.environ.get("CAT_RETRY_BASE", "0.2"))
+# После скольких неудач подряд сервис считается лежащим и на сколько секунд
+CAT_BREAKER_FAILURES = int(os.environ.get("CAT_BREAKER_FAILURES", "5"))
+CAT_BREAKER_COOLDOWN = float(os.environ.get("CAT_BREAKER_COOLDOWN", "30"))
+
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(CAT_MAX_CONCURRENCY)
+
+# Circuit breaker: счётчик неудач подряд и момент, до которого запросы не отправляются
+_breaker_lock = threading.Lock()
+_consecutive_failures = 0
+_open_until = 0.0
+_trial_in_flight = False
+
+_stats_lock = threading.Lock()
+_stats: Dict[str, Dict[str, Any]] = {}
+
+
+class _RetryableStatus(Exception):
+    pass
+
+
+def _get_session() -> requests.Session:
+    """Одна сессия с пулом соединений на процесс: без нового TCP/TLS на каждый запрос"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=2, pool_maxsize=CAT_MAX_CONCURRENCY)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _session = session
+        return _session
+
+
+def _breaker_allows() -> bool:
+    """Закрыт — пропускаем; открыт — нет; после паузы пропускаем один пробный запрос"""
+    global _trial_in_flight
+    with _breaker_lock:
+        if _consecutive_failures < CAT_BREAKER_FAILURES:
+            return True
+        if time.monotonic() < _open_until or _trial_in_flight:
+            return False
+        _trial_in_flight = True
+        return True
+
+
+def _breaker_record(ok: bool) -> None:
+    global _consecutive_failures, _open_until, _trial_in_flight
+    with _breaker_lock:
+        _trial_in_flight = False
+        if ok:
+            _consecutive_failures = 0
+            return
+        _consecutive_failures += 1
+        if _consecutive_failures >= CAT_BREAKER_FAILURES:
+            if time.monotonic() >= _open_until:
+                print(f"⚠️ Сервис котов недоступен, запросы приостановлены на {CAT_BREAKER_COOLDOWN:.0f} с")
+            _open_until = time.monotonic() + CAT_BREAKER_COOLDOWN
+
+
+def _breaker_cancel_trial() -> None:
+    """Пробный запрос не состоялся — даём шанс следующему"""
+    global _trial_in_flight
+    with _breaker_lock:
+        _trial_in_flight = False
+
+
+def _record(kind: str, outcome: str, seconds: float) -> None:
+    with _stats_lock:
+        stats = _stats.setdefault(kind, {"calls": 0, "latencies_ms": deque(maxlen=256)})
+        stats["calls"] += 1
+        stats[outcome] = stats.get(outcome, 0) + 1
+        if outcome in ("ok", "error"):
+            stats["latencies_ms"].append(1000 * seconds)
+
+
+def _get(kind: str, url: str) -> Optional[requests.Response]:
+    """
+    GET с повторами и джиттером. None — сервис недоступен, перегружен или
+    выключен предохранителем; вызывающий сразу переходит к заглушке.
+    """
+    if not _breaker_allows():
+        _record(kind, "short_circuited", 0.0)
+        return None
+    if not _slots.acquire(timeout=CAT_QUEUE_TIMEOUT):
+        _record(kind, "saturated", 0.0)
+        _breaker_cancel_trial()
+        return None
+
+    started = time.perf_counter()
+    # Ответ 4xx означает, что сервис жив: предохранитель он не размыкает
+    reachable = False
+    try:
+        for attempt in range(CAT_RETRIES + 1):
+            try:
+                resp = _get_session().get(url, timeout=(CAT_CONNECT_TIMEOUT, CAT_READ_TIMEOUT))
+                if resp.status_code >= 500:
+                    raise _RetryableStatus(f"HTTP {resp.status_code}")
+                resp.raise_for_status()
+                _breaker_record(ok=True)
+                _record(kind, "ok", time.perf_counter() - started)
+                return resp
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, _RetryableStatus) as e:
+                if attempt == CAT_RETRIES:
+                    print(f"❌ Сервис котов ({kind}): {e}")
+                    break
+                # Экспоненциальная пауза с полным джиттером, чтобы повторы не шли волной
+                time.sleep(random.uniform(0, CAT_RETRY_BASE * (2 ** attempt)))
+            except requests.exceptions.RequestException as e:
+                print(f"❌ Сервис котов ({kind}): {e}")
+                reachable = isinstance(e, requests.exceptions.HTTPError)
+                break
+        _breaker_record(ok=reachable)
+        _record(kind, "error", time.perf_counter() - started)
+        return None
+    finally:
+        _slots.release()
+
+
+def random_cat_url() -> Optional[str]:
+    """URL случайного кота или None"""
+    resp = _get("random", f"{CAT_API_URL}/random.json")
+    if resp is None:
+        return None
+    try:
+        return resp.json().get("url")
+    except ValueError:
+        print("❌ Сервис котов вернул не JSON")
+        return None
+
+
+def fetch_image(url: str) -> Optional[bytes]:
+    """Байты картинки по URL или None, если пришло не изображение"""
+    resp = _get("image", url)
+    if resp is None:
+        return None
+    if not resp.headers.get("content-type", "").startswith("image/"):
+        print("❌ Полученные данные не являются изображением")
+        return None
+    return resp.content
+
+
+def random_cat_image() -> Optional[bytes]:
+    """Картинка случайного кота или None"""
+    url = random_cat_url()
+    return fetch_image(url) if url else None
+
+
+def stats() -> Dict[str, Any]:
+    """Задержки и ошибки по видам запросов и состояние предохранителя"""
+    with _stats_lock:
+        calls = {}
+        for kind, entry in _stats.items():
+            latencies = sorted(entry["latencies_ms"])
+            calls[kind] = dict(
+                {k: v for k, v in entry.items() if k != "latencies_ms"},
+                p50_ms=round(latencies[len(latencies) // 2], 1) if latencies else None,
+                p95_ms=round(latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))], 1) if latencies else None,
+            )
+    with _breaker_lock:
+        open_for = max(0.0, _open_until - time.monotonic())
+        breaker = {
+            "state": "open" if _consecutive_failures >= CAT_BREAKER_FAILURES and open_for > 0 else
+                     ("half_open" if _consecutive_failures >= CAT_BREAKER_FAILURES else "closed"),
+            "consecutive_failures": _consecutive_failures,
+            "open_for_seconds": round(open_for, 1),
+        }
+    return {"base_url": CAT_API_URL, "calls": calls, "breaker": breaker}
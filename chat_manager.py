@@ -1,43 +1,89 @@
 from __future__ import annotations
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 import uuid
 import os
-import requests
 from io import BytesIO
 from PIL import Image, ImageDraw
 import random
-import base64
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, Future
 
-from db_manager import get_session, Chat, serialize_history, deserialize_history
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+from db_manager import get_session, store_chat_images, content_hash, Chat, ChatImage, Message
 from ai_core import generate_chat_title
+import cat_client
+from avatar_pool import AvatarPool, AvatarPair
 
+# Сколько готовых аватаров держать в памяти и сколько ещё на диске
+AVATAR_POOL_SIZE = int(os.environ.get("AVATAR_POOL_SIZE", "8"))
+AVATAR_POOL_SPILL = int(os.environ.get("AVATAR_POOL_SPILL", "32"))
+# Папка внутри приложения (как model_cache): у каждого экземпляра своя, доступ только владельцу
+AVATAR_POOL_DIR = os.environ.get("AVATAR_POOL_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "avatar_cache"))
+
+# Сколько чатов в одной странице списка на /platform и /api/chats
+CHATS_PAGE_SIZE = int(os.environ.get("CHATS_PAGE_SIZE", "30"))
+CHATS_PAGE_MAX = 100
+
+# Сколько последних сообщений показывать на странице чата и передавать модели
+HISTORY_PAGE_SIZE = int(os.environ.get("HISTORY_PAGE_SIZE", "50"))
+CONTEXT_MESSAGES = int(os.environ.get("CONTEXT_MESSAGES", "10"))
+# Сколько раз повторить вставку сообщения, если параллельный ход занял тот же seq
+_APPEND_RETRIES = 5
+
+# Название, которое чат получает сразу; настоящее генерируется в фоне
+_TITLE_PLACEHOLDER = "Новый чат с Космокотом"
+# Сколько названий генерируется одновременно
+TITLE_WORKERS = int(os.environ.get("TITLE_WORKERS", "1"))
+# Через сколько секунд незаконченное название генерируется заново
+# (воркер, который его генерировал, мог перезапуститься)
+TITLE_RETRY_AFTER = float(os.environ.get("TITLE_RETRY_AFTER", "120"))
+
+_title_executor = ThreadPoolExecutor(max_workers=TITLE_WORKERS, thread_name_prefix="cosmocat-title")
+# chat_id -> задача генерации названия в этом процессе, пока она не закончилась;
+# для всех воркеров признак ожидания — chats.title_pending_since
+_title_jobs: Dict[str, Future] = {}
+_title_jobs_lock = threading.Lock()
+
+
+def _download_cat_image() -> Optional[bytes]:
+    """Скачать изображение случайного кота; None, если сервис недоступен"""
+    return cat_client.random_cat_image()
 
-def _fetch_cat_image_bytes() -> Optional[bytes]:
-    """Получить изображение кота с aleatori.cat"""
-    try:
-        # Получаем JSON с информацией о случайном коте
-        url = "https://aleatori.cat/random.json"
-        resp = requests.get(url, timeout=5)
-        resp.raise_for_status()
-        data = resp.json()
-        
-        # Берем URL изображения из ответа
-        img_url = data["url"]
-        
-        # Загружаем само изображение
-        img_resp = requests.get(img_url, timeout=10)
-        img_resp.raise_for_status()
-        
-        # Проверяем, что это действительно изображение
-        if img_resp.headers.get('content-type', '').startswith('image/'):
-            return img_resp.content
-        else:
-            print("❌ Полученные данные не являются изображением")
-            return _load_default_avatar()
-            
-    except Exception as e:
-        print(f"❌ Ошибка получения кота с aleatori.cat: {e}")
-        return _load_default_avatar()
+
+def _make_avatar_pair() -> Optional[AvatarPair]:
+    """Скачать кота и подготовить аватар 500x500 и иконку 64x64"""
+    cat_bytes = _download_cat_image()
+    avatar = _circle_crop(cat_bytes, 500) if cat_bytes else None
+    icon = _circle_crop(avatar, 64) if avatar else None
+    return (avatar, icon) if avatar and icon else None
+
+
+_avatar_pool = AvatarPool(_make_avatar_pair, AVATAR_POOL_SIZE, AVATAR_POOL_DIR, AVATAR_POOL_SPILL)
+_default_pair: Optional[AvatarPair] = None
+
+
+def start_avatar_pool() -> None:
+    """Начать заранее готовить аватары для новых чатов"""
+    _avatar_pool.start()
+
+
+def _default_avatar_pair() -> Optional[AvatarPair]:
+    """Аватар и иконка из default_avatar.png (готовятся один раз)"""
+    global _default_pair
+    if _default_pair is None:
+        default_avatar = _load_default_avatar()
+        avatar = _circle_crop(default_avatar, 500) if default_avatar else None
+        icon = _circle_crop(avatar, 64) if avatar else None
+        if avatar and icon:
+            _default_pair = (avatar, icon)
+    return _default_pair
+
+
+def avatar_pool_stats() -> Dict[str, any]:
+    return _avatar_pool.stats()
 
 
 def _load_default_avatar() -> Optional[bytes]:
@@ -63,26 +109,109 @@ def _load_default_avatar() -> Optional[bytes]:
 def get_chat_avatar(chat_id: str) -> Optional[bytes]:
     """Получить аватар чата по его ID"""
     with get_session() as session:
-        chat = session.query(Chat).filter_by(chat_id=chat_id).first()
-        if chat and chat.cat_avatar_blob:
-            return chat.cat_avatar_blob
+        return session.query(ChatImage.avatar_blob).filter(ChatImage.chat_id == chat_id).scalar()
+
+
+def get_chat_image_hashes(chat_id: str) -> Optional[Dict[str, Optional[str]]]:
+    """Хэши аватара и иконки чата без загрузки картинок"""
+    with get_session() as session:
+        row = (
+            session.query(Chat.cat_avatar_hash, Chat.icon_hash)
+            .filter(Chat.chat_id == chat_id)
+            .first()
+        )
+    if row is None:
         return None
+    return {"avatar": row.cat_avatar_hash, "icon": row.icon_hash}
 
 
-def update_chat_avatar(chat_id: str, avatar_blob: bytes) -> None:
-    """Обновить аватар чата"""
+def get_chat_icon(chat_id: str) -> Optional[bytes]:
+    """Получить иконку чата по его ID"""
+    with get_session() as session:
+        return session.query(ChatImage.icon_blob).filter(ChatImage.chat_id == chat_id).scalar()
+
+
+def update_chat_avatar(chat_id: str, avatar_blob: bytes, icon_blob: Optional[bytes] = None) -> None:
+    """Обновить аватар чата (и иконку, если она передана)"""
     with get_session() as session:
         chat = session.query(Chat).filter_by(chat_id=chat_id).first()
         if chat:
-            chat.cat_avatar_blob = avatar_blob
+            store_chat_images(session, chat, avatar_blob, icon_blob)
             session.commit()
 
 
+def _store_missing_avatar(chat_id: str, pair: AvatarPair) -> bool:
+    """
+    Сохраняет пару, только если у чата ещё нет аватара. Условный UPDATE
+    хэша решает гонку между запросами и воркерами: False — аватар уже
+    сохранил кто-то другой (или чата нет), пара не использована.
+    """
+    with get_session() as session:
+        claimed = session.query(Chat).filter(
+            Chat.chat_id == chat_id, Chat.cat_avatar_hash.is_(None)
+        ).update({Chat.cat_avatar_hash: content_hash(pair[0])}, synchronize_session=False)
+        if claimed:
+            store_chat_images(session, _load_chat(session, chat_id), pair[0], pair[1])
+    return bool(claimed)
+
+
+# Чаты, для которых сейчас генерируется аватар
+_avatar_jobs: Dict[str, Future] = {}
+_avatar_jobs_lock = threading.Lock()
+_avatar_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="cosmocat-chat-avatar")
+
+
+def _avatar_job(chat_id: str) -> None:
+    try:
+        pair = _make_avatar_pair()
+        if pair is None:
+            return
+        if _store_missing_avatar(chat_id, pair):
+            print(f"✅ Аватар чата {chat_id} сохранён")
+        else:
+            _avatar_pool.put_back(pair)
+    except Exception as e:
+        print(f"❌ Ошибка генерации аватара чата {chat_id}: {e}")
+    finally:
+        with _avatar_jobs_lock:
+            _avatar_jobs.pop(chat_id, None)
+
+
+def request_chat_avatar(chat_id: str) -> Optional[bytes]:
+    """
+    Аватар для чата, у которого его нет. Если в пуле есть готовый — он сразу
+    сохраняется и возвращается. Иначе генерация ставится в фон (одна на чат
+    независимо от числа одновременных запросов) и возвращается None.
+    """
+    with get_session() as session:
+        if session.query(Chat.id).filter(Chat.chat_id == chat_id).first() is None:
+            return None
+
+    pair = _avatar_pool.pop()
+    if pair:
+        if _store_missing_avatar(chat_id, pair):
+            return pair[0]
+        # Параллельный запрос успел сохранить свой аватар — пара достанется другому чату
+        _avatar_pool.put_back(pair)
+        return get_chat_avatar(chat_id)
+
+    with _avatar_jobs_lock:
+        if chat_id not in _avatar_jobs:
+            _avatar_jobs[chat_id] = _avatar_executor.submit(_avatar_job, chat_id)
+    return None
+
+
 def _load_chat(session, chat_id: str) -> Optional[Chat]:
-    """Загрузить чат из базы данных"""
+    """Загрузить чат из базы данных (картинки не загружаются)"""
     return session.query(Chat).filter(Chat.chat_id == chat_id).first()
 
 
+def user_owns_chat(chat_id: str, user_id: int) -> bool:
+    """Принадлежит ли чат пользователю (одна строка по индексу, без загрузки чатов)"""
+    with get_session() as session:
+        return session.query(Chat.id).filter(Chat.chat_id == chat_id, Chat.user_id == user_id).first() is not None
+
+
 def _circle_crop(image_bytes: bytes, size: int = 500) -> Optional[bytes]:
     """Обрезает изображение по ширине до квадрата, масштабирует до нужного размера и делает круглую обрезку"""
     try:
@@ -118,59 +247,142 @@ def create_chat(user_id: int, first_message: str = None) -> str:
     """Создать новый чат с аватаром кота и сгенерированным названием"""
     chat_id = uuid.uuid4().hex[:16]
     
+    # Готовый аватар из пула; если пул пуст — аватар по умолчанию
+    circle_bytes, icon_bytes = _avatar_pool.pop() or _default_avatar_pair() or (None, None)
+    
     with get_session() as session:
-        # Получаем аватар кота
-        cat_bytes = _fetch_cat_image_bytes()
-        circle_bytes = _circle_crop(cat_bytes, 500) if cat_bytes else None
-        
-        if not circle_bytes:
-            default_avatar = _load_default_avatar()
-            circle_bytes = _circle_crop(default_avatar, 500) if default_avatar else None
-        
-        # Создаем иконку (маленький аватар 64x64)
-        icon_bytes = _circle_crop(circle_bytes, 64) if circle_bytes else None
-        
-        # Генерируем название чата
-        if first_message:
-            title = generate_chat_title(first_message)
-        else:
-            title = "Новый чат с Космокотом"
+        # Название генерируется в фоне, пока ставим заглушку
+        title = _TITLE_PLACEHOLDER
         
         chat = Chat(
             user_id=user_id,
             chat_id=chat_id,
-            chat_history=serialize_history([]),
-            cat_avatar_blob=circle_bytes,
             title=title,
-            icon_blob=icon_bytes,
         )
         session.add(chat)
+        if circle_bytes is not None:
+            store_chat_images(session, chat, circle_bytes, icon_bytes)
         session.commit()
         
         print(f"✅ Создан чат '{title}' ({chat_id}) для пользователя {user_id}")
-        return chat_id
+
+    if first_message:
+        schedule_chat_title(chat_id, first_message)
+    return chat_id
+
+
+def _set_chat_title(chat_id: str, title: Optional[str]) -> None:
+    """Записать название чата (None — оставить заглушку) и снять признак ожидания"""
+    with get_session() as session:
+        chat = _load_chat(session, chat_id)
+        if chat:
+            if title is not None:
+                chat.title = title
+            chat.title_pending_since = None
+            session.commit()
+
+
+def _title_job(chat_id: str, first_message: str) -> None:
+    try:
+        title = generate_chat_title(first_message)
+        _set_chat_title(chat_id, title)
+        print(f"✅ Название чата {chat_id}: '{title}'")
+    except Exception as e:
+        print(f"❌ Ошибка генерации названия чата {chat_id}: {e}")
+        # Заглушка остаётся, но страница чата перестаёт ждать название
+        _set_chat_title(chat_id, None)
+    finally:
+        with _title_jobs_lock:
+            _title_jobs.pop(chat_id, None)
+
+
+def _submit_title_job(chat_id: str, first_message: str) -> None:
+    with _title_jobs_lock:
+        if chat_id in _title_jobs:
+            return
+        _title_jobs[chat_id] = _title_executor.submit(_title_job, chat_id, first_message)
+
+
+def schedule_chat_title(chat_id: str, first_message: str) -> None:
+    """
+    Поставить генерацию названия чата в фоновую очередь.
+    Признак ожидания пишется в строку чата, чтобы его видели все воркеры;
+    в одном процессе для чата выполняется не больше одной задачи.
+    """
+    with get_session() as session:
+        session.query(Chat).filter(Chat.chat_id == chat_id).update(
+            {Chat.title_pending_since: time.time()}, synchronize_session=False
+        )
+    _submit_title_job(chat_id, first_message)
+
+
+def _retry_title(chat_id: str, pending_since: float) -> None:
+    """
+    Заново ставит название, которое слишком долго не готово. Условный UPDATE
+    забирает чат у остальных воркеров: повтор запустит только один из них.
+    """
+    with get_session() as session:
+        claimed = session.query(Chat).filter(
+            Chat.chat_id == chat_id, Chat.title_pending_since == pending_since
+        ).update({Chat.title_pending_since: time.time()}, synchronize_session=False)
+        first_message = session.query(Message.content).filter(
+            Message.chat_id == chat_id, Message.seq == 0
+        ).scalar()
+    if not claimed:
+        return
+    if first_message is None:
+        _set_chat_title(chat_id, None)
+        return
+    print(f"⚠️ Название чата {chat_id} не готово {TITLE_RETRY_AFTER:.0f} с, генерируем заново")
+    _submit_title_job(chat_id, first_message)
+
+
+def _title_pending(chat_id: str, pending_since: Optional[float]) -> bool:
+    if pending_since is None:
+        return False
+    if time.time() - pending_since > TITLE_RETRY_AFTER:
+        _retry_title(chat_id, pending_since)
+    return True
+
+
+def get_chat_title(chat_id: str) -> Optional[Dict[str, any]]:
+    """Текущее название чата и признак того, что настоящее ещё генерируется"""
+    with get_session() as session:
+        row = session.query(Chat.title, Chat.title_pending_since).filter(Chat.chat_id == chat_id).first()
+    if row is None:
+        return None
+    return {
+        "chat_id": chat_id,
+        "title": row.title or "Чат с Космокотом",
+        "pending": _title_pending(chat_id, row.title_pending_since),
+    }
 
 
-def list_chats(user_id: int) -> List[Dict[str, any]]:
-    """Получить список чатов пользователя с иконками и названиями"""
+def list_chats(user_id: int, before: Optional[int] = None, limit: Optional[int] = None) -> List[Dict[str, any]]:
+    """
+    Получить список чатов пользователя с иконками и названиями, новые первыми.
+    Постранично: before — cursor последнего чата предыдущей страницы
+    (чаты с меньшим Chat.id), limit — размер страницы.
+    """
     result: List[Dict[str, any]] = []
     with get_session() as session:
-        rows = (
-            session.query(Chat)
+        query = (
+            session.query(Chat.id, Chat.chat_id, Chat.title, Chat.icon_hash)
             .filter(Chat.user_id == user_id)
-            .order_by(Chat.id.desc())
-            .all()
         )
-        for c in rows:
-            # Конвертируем иконку в base64 для фронтенда
-            icon_base64 = None
-            if c.icon_blob:
-                icon_base64 = base64.b64encode(c.icon_blob).decode('utf-8')
-            
+        # Keyset вместо OFFSET: каждая страница читает ровно limit строк по индексу
+        if before is not None:
+            query = query.filter(Chat.id < before)
+        query = query.order_by(Chat.id.desc())
+        if limit:
+            query = query.limit(limit)
+        for c in query.all():
+            # Иконка отдаётся отдельным URL с версией, а не base64 в странице
             result.append({
                 "chat_id": c.chat_id,
                 "title": c.title or "Чат с Космокотом",
-                "icon": icon_base64
+                "icon_hash": c.icon_hash,
+                "cursor": c.id,
             })
     return result
 
@@ -178,76 +390,120 @@ def list_chats(user_id: int) -> List[Dict[str, any]]:
 def get_chat_info(chat_id: str) -> Optional[Dict[str, any]]:
     """Получить информацию о чате (название, иконка)"""
     with get_session() as session:
-        chat = _load_chat(session, chat_id)
-        if not chat:
-            return None
-            
-        icon_base64 = None
-        if chat.icon_blob:
-            icon_base64 = base64.b64encode(chat.icon_blob).decode('utf-8')
-            
-        return {
-            "chat_id": chat.chat_id,
-            "title": chat.title or "Чат с Космокотом",
-            "icon": icon_base64
-        }
+        chat = (
+            session.query(Chat.chat_id, Chat.title, Chat.icon_hash, Chat.cat_avatar_hash, Chat.title_pending_since)
+            .filter(Chat.chat_id == chat_id)
+            .first()
+        )
+    if not chat:
+        return None
 
+    return {
+        "chat_id": chat.chat_id,
+        "title": chat.title or "Чат с Космокотом",
+        "icon_hash": chat.icon_hash,
+        "avatar_hash": chat.cat_avatar_hash,
+        "title_pending": _title_pending(chat_id, chat.title_pending_since),
+    }
 
-def get_chat_history(chat_id: str) -> List[Dict]:
-    """Получить историю сообщений чата"""
+
+def get_chat_history(chat_id: str, limit: Optional[int] = None) -> List[Dict]:
+    """Получить историю сообщений чата: последние limit сообщений (или все) по порядку"""
     with get_session() as session:
-        chat = _load_chat(session, chat_id)
-        if not chat:
-            return []
-    return deserialize_history(chat.chat_history)
+        query = (
+            session.query(Message.role, Message.content)
+            .filter(Message.chat_id == chat_id)
+            .order_by(Message.seq.desc())
+        )
+        if limit:
+            query = query.limit(limit)
+        rows = query.all()
+    return [{"role": m.role, "content": m.content} for m in reversed(rows)]
+
+
+def _next_seq(session, chat_id: str) -> int:
+    """Номер следующего сообщения чата (максимум по индексу (chat_id, seq))"""
+    last = session.query(func.max(Message.seq)).filter(Message.chat_id == chat_id).scalar()
+    return 0 if last is None else last + 1
 
 
 def append_message(chat_id: str, role: str, content: str) -> None:
-    """Добавить сообщение в историю чата"""
-    with get_session() as session:
-        chat = _load_chat(session, chat_id)
-        if not chat:
+    """Добавить сообщение в историю чата (одна вставка, история не перечитывается)"""
+    for attempt in range(_APPEND_RETRIES):
+        try:
+            with get_session() as session:
+                if session.query(Chat.id).filter(Chat.chat_id == chat_id).first() is None:
+                    return
+                seq = _next_seq(session, chat_id)
+                session.add(Message(chat_id=chat_id, seq=seq, role=role, content=content))
+            break
+        except IntegrityError:
+            # Параллельный ход успел вставить сообщение с тем же seq — берём следующий
+            if attempt == _APPEND_RETRIES - 1:
+                raise
+
+    # Если это первое сообщение пользователя, название генерируется в фоне
+    if role == 'user' and seq == 0:
+        schedule_chat_title(chat_id, content)
+
+
+def begin_turn(chat_id: str, user_id: int, message: str) -> Optional[Tuple[int, List[Dict]]]:
+    """
+    Начало хода одной транзакцией: проверяет владельца, сохраняет сообщение
+    пользователя и возвращает (его seq, контекст для модели) — последние
+    CONTEXT_MESSAGES сообщений вместе с новым. None — чата нет или он чужой.
+    """
+    for attempt in range(_APPEND_RETRIES):
+        try:
+            with get_session() as session:
+                if session.query(Chat.id).filter(Chat.chat_id == chat_id, Chat.user_id == user_id).first() is None:
+                    return None
+                # Окно контекста заодно даёт номер последнего сообщения — отдельный MAX(seq) не нужен
+                rows = (
+                    session.query(Message.seq, Message.role, Message.content)
+                    .filter(Message.chat_id == chat_id)
+                    .order_by(Message.seq.desc())
+                    .limit(max(1, CONTEXT_MESSAGES - 1))
+                    .all()
+                )
+                seq = rows[0].seq + 1 if rows else 0
+                session.add(Message(chat_id=chat_id, seq=seq, role='user', content=message))
+            break
+        except IntegrityError:
+            # Ход из другой вкладки занял этот seq — перечитываем окно и пробуем снова
+            if attempt == _APPEND_RETRIES - 1:
+                raise
+
+    if seq == 0:
+        schedule_chat_title(chat_id, message)
+    context = [{"role": m.role, "content": m.content} for m in reversed(rows)]
+    context.append({"role": "user", "content": message})
+    return seq, context[-CONTEXT_MESSAGES:]
+
+
+def finish_turn(chat_id: str, user_seq: int, reply: str) -> None:
+    """
+    Сохраняет ответ ассистента сразу после сообщения пользователя (user_seq + 1).
+    Если за время генерации в чат написали из другой вкладки, ответ встаёт в конец.
+    """
+    seq = user_seq + 1
+    for attempt in range(_APPEND_RETRIES):
+        try:
+            with get_session() as session:
+                if seq is None:
+                    seq = _next_seq(session, chat_id)
+                session.add(Message(chat_id=chat_id, seq=seq, role='assistant', content=reply))
             return
-            
-        history = deserialize_history(chat.chat_history)
-        
-        # Если это первое сообщение пользователя, генерируем название чата
-        if role == 'user' and len(history) == 0:
-            title = generate_chat_title(content)
-            chat.title = title
-        
-        history.append({"role": role, "content": content})
-
-        def _prune_history(hist: List[Dict]) -> List[Dict]:
-            """Ограничить историю последними 5 парами сообщений пользователь-ассистент"""
-            picked_rev = []
-            user_count = 0
-            assistant_count = 0
-            for m in reversed(hist):
-                r = m.get("role", "user")
-                if r == "user" and user_count < 5:
-                    picked_rev.append(m)
-                    user_count += 1
-                elif r == "assistant" and assistant_count < 5:
-                    picked_rev.append(m)
-                    assistant_count += 1
-                if user_count >= 5 and assistant_count >= 5:
-                    break
-            return list(reversed(picked_rev))
-
-        pruned = _prune_history(history)
-        chat.chat_history = serialize_history(pruned)
-        session.commit()
+        except IntegrityError:
+            if attempt == _APPEND_RETRIES - 1:
+                raise
+            seq = None
 
 
 def clear_history(chat_id: str) -> None:
     """Очистить историю сообщений чата"""
     with get_session() as session:
-        chat = _load_chat(session, chat_id)
-        if not chat:
-            return
-        chat.chat_history = serialize_history([])
-        session.commit()
+        session.query(Message).filter(Message.chat_id == chat_id).delete(synchronize_session=False)
 
 
 def process_avatar(image_bytes: bytes, size: int = 500) -> Optional[bytes]:
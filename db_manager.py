@@ -3,7 +3,9 @@ from typing import Optional, Iterator, List, Dict, Any
 from contextlib import contextmanager
 import os
 import json
-from sqlalchemy import create_engine, String, Integer, LargeBinary, ForeignKey
+import hashlib
+from sqlalchemy import create_engine, inspect, text, String, Integer, Float, Boolean, Text, LargeBinary, ForeignKey, Index
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship, sessionmaker, Session
 
 class Base(DeclarativeBase):
@@ -20,7 +22,176 @@ def init_db(database_url: Optional[str] = None) -> None:
     url = database_url or get_database_url()
     _engine = create_engine(url, future=True)
     SessionLocal = sessionmaker(bind=_engine, autoflush=False, expire_on_commit=False, future=True)
-    Base.metadata.create_all(_engine)
+    _create_tables(_engine)
+    _migrate(_engine)
+
+def _create_tables(engine) -> None:
+    """create_all, который переживает параллельный запуск нескольких воркеров"""
+    for table in Base.metadata.sorted_tables:
+        try:
+            table.create(engine, checkfirst=True)
+        except DBAPIError:
+            # Другой воркер успел создать таблицу между проверкой и CREATE TABLE
+            if not inspect(engine).has_table(table.name):
+                raise
+
+# Колонки, добавленные после первого релиза: (таблица, колонка, тип)
+_ADDED_COLUMNS = [
+    ("users", "avatar_hash", "VARCHAR(64)"),
+    ("chats", "cat_avatar_hash", "VARCHAR(64)"),
+    ("chats", "icon_hash", "VARCHAR(64)"),
+    ("chats", "title_pending_since", "FLOAT"),
+]
+# Картинки, которые раньше хранились в самих строках users/chats:
+# (таблица, ключ строки, отдельная таблица, её ключ, {старая колонка: новая колонка})
+_LEGACY_IMAGE_COLUMNS = [
+    ("users", "id", "user_avatars", "user_id", {"avatar_blob": "avatar_blob"}),
+    ("chats", "chat_id", "chat_images", "chat_id", {"cat_avatar_blob": "avatar_blob", "icon_blob": "icon_blob"}),
+]
+# Хэш-колонка -> картинка, из которой он считается:
+# (таблица, хэш, ключ строки, таблица картинок, её ключ, колонка с картинкой)
+_HASHED_IMAGES = [
+    ("users", "avatar_hash", "id", "user_avatars", "user_id", "avatar_blob"),
+    ("chats", "cat_avatar_hash", "chat_id", "chat_images", "chat_id", "avatar_blob"),
+    ("chats", "icon_hash", "chat_id", "chat_images", "chat_id", "icon_blob"),
+]
+
+def _columns(engine, table: str) -> set:
+    return {c["name"] for c in inspect(engine).get_columns(table)}
+
+def _add_column(engine, table: str, column: str, column_type: str) -> None:
+    """ALTER TABLE ADD COLUMN, который переживает параллельный запуск нескольких воркеров"""
+    try:
+        with engine.begin() as conn:
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}"))
+    except DBAPIError:
+        # Другой воркер успел добавить колонку между проверкой и ALTER TABLE
+        if column not in _columns(engine, table):
+            raise
+
+def _migrate(engine) -> None:
+    """Добавляет недостающие колонки в существующую базу, переносит картинки и заполняет их хэши"""
+    existing = {table: _columns(engine, table) for table in ("users", "chats")}
+    for table, column, column_type in _ADDED_COLUMNS:
+        if column not in existing[table]:
+            _add_column(engine, table, column, column_type)
+    _migrate_images(engine, existing)
+    with engine.begin() as conn:
+        for table, hash_column, key, image_table, image_key, blob_column in _HASHED_IMAGES:
+            # Картинки читаются по одной, чтобы не держать в памяти все сразу
+            row_keys = conn.execute(text(
+                f"SELECT t.{key} FROM {table} t JOIN {image_table} i ON i.{image_key} = t.{key} "
+                f"WHERE t.{hash_column} IS NULL AND i.{blob_column} IS NOT NULL"
+            )).scalars().all()
+            for row_key in row_keys:
+                blob = conn.execute(
+                    text(f"SELECT {blob_column} FROM {image_table} WHERE {image_key} = :k"), {"k": row_key}
+                ).scalar()
+                conn.execute(
+                    text(f"UPDATE {table} SET {hash_column} = :h WHERE {key} = :k"),
+                    {"h": content_hash(blob), "k": row_key},
+                )
+    # create_all не добавляет индексы в уже существующие таблицы
+    for index in Chat.__table__.indexes:
+        index.create(engine, checkfirst=True)
+    _migrate_history(engine)
+
+def _migrate_images(engine, existing: Dict[str, set]) -> None:
+    """Переносит картинки из строк users/chats в user_avatars/chat_images"""
+    moved_any = False
+    for table, key, image_table, image_key, mapping in _LEGACY_IMAGE_COLUMNS:
+        legacy = {old: new for old, new in mapping.items() if old in existing[table]}
+        if not legacy:
+            continue
+        not_null = " OR ".join(f"{old} IS NOT NULL" for old in legacy)
+        moved = 0
+        with engine.begin() as conn:
+            row_keys = conn.execute(text(f"SELECT {key} FROM {table} WHERE {not_null}")).scalars().all()
+            for row_key in row_keys:
+                # Картинки копируются по одной строке; NOT EXISTS и обнуление в той же
+                # транзакции делают перенос безопасным при параллельном запуске воркеров
+                conn.execute(
+                    text(
+                        f"INSERT INTO {image_table} ({image_key}, {', '.join(legacy.values())}) "
+                        f"SELECT {key}, {', '.join(legacy)} FROM {table} WHERE {key} = :k AND ({not_null}) "
+                        f"AND NOT EXISTS (SELECT 1 FROM {image_table} WHERE {image_key} = :k)"
+                    ),
+                    {"k": row_key},
+                )
+                moved += conn.execute(
+                    text(f"UPDATE {table} SET {', '.join(f'{old} = NULL' for old in legacy)} WHERE {key} = :k AND ({not_null})"),
+                    {"k": row_key},
+                ).rowcount
+        if moved:
+            print(f"✅ Картинки {moved} строк {table} перенесены в таблицу {image_table}")
+            moved_any = True
+    if moved_any and engine.dialect.name == "sqlite":
+        _vacuum(engine)
+
+def _vacuum(engine) -> None:
+    """
+    После переноса картинок строки chats/users стали короткими, но остались
+    по одной на странице; VACUUM собирает их плотно, иначе список чатов
+    по-прежнему читает страницу на каждый чат.
+    """
+    try:
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.execute(text("VACUUM"))
+        print("✅ База уплотнена после переноса картинок")
+    except DBAPIError as e:
+        # Например, база занята другим воркером; уплотнить можно и позже вручную
+        print(f"⚠️ VACUUM не выполнен: {e}")
+
+def _migrate_history(engine) -> None:
+    """Переносит JSON-историю из chats.chat_history в таблицу messages"""
+    with engine.connect() as conn:
+        chat_ids = conn.execute(text("SELECT chat_id FROM chats WHERE chat_history IS NOT NULL")).scalars().all()
+    moved = 0
+    for chat_id in chat_ids:
+        # Каждый чат — своя транзакция. Первая запись в ней захватывает строку:
+        # параллельный воркер ждёт конца транзакции и видит, что чат уже перенесён
+        with engine.begin() as conn:
+            claimed = conn.execute(
+                text("UPDATE chats SET chat_history = chat_history WHERE chat_id = :chat_id AND chat_history IS NOT NULL"),
+                {"chat_id": chat_id},
+            ).rowcount
+            if not claimed:
+                continue
+            blob = conn.execute(
+                text("SELECT chat_history FROM chats WHERE chat_id = :chat_id"), {"chat_id": chat_id}
+            ).scalar()
+            rows = [
+                {"chat_id": chat_id, "seq": seq, "role": m.get("role", "user"), "content": m.get("content", "")}
+                for seq, m in enumerate(deserialize_history(blob))
+            ]
+            if rows:
+                conn.execute(Message.__table__.insert(), rows)
+            # Пустая колонка означает, что история чата уже перенесена
+            conn.execute(text("UPDATE chats SET chat_history = NULL WHERE chat_id = :chat_id"), {"chat_id": chat_id})
+        moved += 1
+    if moved:
+        print(f"✅ История {moved} чатов перенесена в таблицу messages")
+
+def content_hash(blob: Optional[bytes]) -> Optional[str]:
+    """Хэш содержимого картинки: версия для URL и ETag"""
+    return hashlib.sha256(blob).hexdigest() if blob else None
+
+def store_chat_images(session: Session, chat: Chat, avatar_blob: Optional[bytes], icon_blob: Optional[bytes] = None) -> None:
+    """Записывает аватар (и иконку, если передана) чата в chat_images, а их хэши — в строку chats"""
+    images = session.get(ChatImage, chat.chat_id) or ChatImage(chat_id=chat.chat_id)
+    images.avatar_blob = avatar_blob
+    chat.cat_avatar_hash = content_hash(avatar_blob)
+    if icon_blob is not None:
+        images.icon_blob = icon_blob
+        chat.icon_hash = content_hash(icon_blob)
+    session.add(images)
+
+def store_user_avatar(session: Session, user: User, avatar_blob: Optional[bytes]) -> None:
+    """Записывает аватар пользователя в user_avatars, а его хэш — в строку users"""
+    avatar = session.get(UserAvatar, user.id) or UserAvatar(user_id=user.id)
+    avatar.avatar_blob = avatar_blob
+    user.avatar_hash = content_hash(avatar_blob)
+    session.add(avatar)
 
 @contextmanager
 def get_session() -> Iterator[Session]:
@@ -43,20 +214,76 @@ class User(Base):
     login: Mapped[str] = mapped_column(String(255), unique=True, nullable=False, index=True)
     password_hash: Mapped[str] = mapped_column(String(255), nullable=False)
     name: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
-    avatar_blob: Mapped[Optional[bytes]] = mapped_column(LargeBinary, nullable=True)
+    # Сам аватар лежит в user_avatars, здесь только его хэш
+    avatar_hash: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
     chats: Mapped[List["Chat"]] = relationship(back_populates="user", cascade="all, delete-orphan")
 
+class UserAvatar(Base):
+    """Аватар пользователя отдельно от users: user_loader на каждом запросе не читает картинку"""
+    __tablename__ = "user_avatars"
+    user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"), primary_key=True)
+    avatar_blob: Mapped[Optional[bytes]] = mapped_column(LargeBinary, nullable=True)
+
 class Chat(Base):
     __tablename__ = "chats"
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"), index=True, nullable=False)
     chat_id: Mapped[str] = mapped_column(String(64), unique=True, nullable=False, index=True)
-    chat_history: Mapped[Optional[bytes]] = mapped_column(LargeBinary, nullable=True)
-    cat_avatar_blob: Mapped[Optional[bytes]] = mapped_column(LargeBinary, nullable=True)
+    # Устаревшая JSON-история: при запуске переносится в messages и обнуляется
+    chat_history: Mapped[Optional[bytes]] = mapped_column(LargeBinary, nullable=True, deferred=True)
     title: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
-    icon_blob: Mapped[Optional[bytes]] = mapped_column(LargeBinary, nullable=True)
+    # time.time(), когда поставлена генерация названия; None — название готово
+    title_pending_since: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+    # Картинки лежат в chat_images, здесь только их хэши
+    cat_avatar_hash: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
+    icon_hash: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
     user: Mapped[User] = relationship(back_populates="chats")
 
+    # Проверка владельца чата одним поиском по индексу
+    __table_args__ = (Index("ix_chats_chat_id_user_id", "chat_id", "user_id"),)
+
+class ChatImage(Base):
+    """
+    Аватар и иконка чата отдельно от chats. Большой блоб в строке SQLite
+    уходит в страницы переполнения, и чтение колонок после него (название,
+    хэши) проходит по ним даже без загрузки самой картинки. Поэтому список
+    чатов, проверка владельца и 304 по хэшу читают только короткие строки chats.
+    """
+    __tablename__ = "chat_images"
+    chat_id: Mapped[str] = mapped_column(String(64), ForeignKey("chats.chat_id"), primary_key=True)
+    avatar_blob: Mapped[Optional[bytes]] = mapped_column(LargeBinary, nullable=True)
+    icon_blob: Mapped[Optional[bytes]] = mapped_column(LargeBinary, nullable=True)
+
+class Message(Base):
+    """Сообщение чата. Строки только добавляются; seq — номер сообщения внутри чата."""
+    __tablename__ = "messages"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    chat_id: Mapped[str] = mapped_column(String(64), ForeignKey("chats.chat_id"), nullable=False)
+    seq: Mapped[int] = mapped_column(Integer, nullable=False)
+    role: Mapped[str] = mapped_column(String(16), nullable=False)
+    content: Mapped[str] = mapped_column(Text, nullable=False)
+
+    # Последние сообщения чата читаются по индексу с LIMIT; уникальность seq
+    # не даёт двум параллельным вставкам занять одно место в истории
+    __table_args__ = (Index("ux_messages_chat_id_seq", "chat_id", "seq", unique=True),)
+
+class ReplyJob(Base):
+    """
+    Состояние генерации ответа для опроса из любого веб-воркера: задачу
+    выполняет воркер, принявший ход, а забрать ответ можно через другой.
+    """
+    __tablename__ = "reply_jobs"
+    job_id: Mapped[str] = mapped_column(String(32), primary_key=True)
+    chat_id: Mapped[str] = mapped_column(String(64), nullable=False)
+    user_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    status: Mapped[str] = mapped_column(String(16), nullable=False)
+    text: Mapped[str] = mapped_column(Text, nullable=False, default="")
+    reply: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    # Отмену может запросить другой воркер; выполняющий видит её при следующей записи
+    cancel_requested: Mapped[bool] = mapped_column(Boolean, nullable=False, default=False)
+    # time.time(): по нему удаляются старые задачи
+    finished_at: Mapped[Optional[float]] = mapped_column(Float, nullable=True, index=True)
+
 def serialize_history(messages: List[Dict[str, Any]]) -> bytes:
     return json.dumps(messages, ensure_ascii=False).encode("utf-8")
 
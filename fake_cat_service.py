@@ -0,0 +1,87 @@
+"""Local stand-in for the aleatori.cat API, for development and load tests.
+
+Запуск: python fake_cat_service.py [--port 8081] [--delay 0.5] [--fail-rate 0.2],
+затем CAT_API_URL=http://127.0.0.1:8081 python app.py
+"""
+
+from __future__ import annotations
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+import argparse
+import json
+import random
+import time
+
+from PIL import Image, ImageDraw
+
+
+def _cat_png(seed: int, size: int = 600) -> bytes:
+    """Простая картинка "кота": цветная мордочка с ушами, цвет зависит от seed"""
+    rnd = random.Random(seed)
+    fur = tuple(rnd.randint(60, 230) for _ in range(3))
+    im = Image.new("RGB", (size, size), (20, 20, 40))
+    draw = ImageDraw.Draw(im)
+    draw.polygon([(size * 0.2, size * 0.35), (size * 0.3, size * 0.1), (size * 0.45, size * 0.3)], fill=fur)
+    draw.polygon([(size * 0.55, size * 0.3), (size * 0.7, size * 0.1), (size * 0.8, size * 0.35)], fill=fur)
+    draw.ellipse((size * 0.15, size * 0.25, size * 0.85, size * 0.9), fill=fur)
+    for x in (0.35, 0.65):
+        draw.ellipse((size * (x - 0.05), size * 0.45, size * (x + 0.05), size * 0.55), fill=(30, 30, 30))
+    out = BytesIO()
+    im.save(out, format="PNG")
+    return out.getvalue()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    delay = 0.0
+    fail_rate = 0.0
+
+    def do_GET(self) -> None:
+        if self.delay:
+            time.sleep(self.delay)
+        if random.random() < self.fail_rate:
+            self.send_error(503, "fake outage")
+            return
+
+        if self.path.startswith("/random.json"):
+            host = self.headers.get("Host", f"127.0.0.1:{self.server.server_port}")
+            body = json.dumps({"url": f"http://{host}/cat/{random.randint(0, 999)}.png"}).encode("utf-8")
+            content_type = "application/json"
+        elif self.path.startswith("/cat/") and self.path.endswith(".png"):
+            try:
+                seed = int(self.path[len("/cat/"):-len(".png")])
+            except ValueError:
+                self.send_error(404)
+                return
+            body = _cat_png(seed)
+            content_type = "image/png"
+        else:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--delay", type=float, default=0.0, help="задержка каждого ответа, секунды")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="доля ответов 503")
+    args = parser.parse_args()
+
+    _Handler.delay = args.delay
+    _Handler.fail_rate = args.fail_rate
+    server = ThreadingHTTPServer((args.host, args.port), _Handler)
+    print(f"✅ Заглушка сервиса котов: http://{args.host}:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
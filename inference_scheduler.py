@@ -0,0 +1,218 @@
+"""Micro-batching scheduler: groups concurrent generation requests and runs them on model replicas."""
+
+from __future__ import annotations
+from typing import Callable, Dict, List, Optional, Any
+import threading
+import time
+
+
+class GenerationRequest:
+    """Один запрос к модели, ожидающий своей очереди в батче."""
+
+    def __init__(self, kind: str, suffix_ids: List[int], generation_kwargs: Dict[str, Any],
+                 streamer=None, extra_criteria: Optional[list] = None, deadline: Optional[float] = None) -> None:
+        self.kind = kind
+        self.suffix_ids = suffix_ids
+        self.generation_kwargs = generation_kwargs
+        # Момент time.monotonic(), после которого генерация обрывается
+        self.deadline = deadline
+        self.deadline_hit = False
+        # Потоковые запросы выполняются по одному: стример поддерживает только батч из 1
+        self.streamer = streamer
+        self.extra_criteria = extra_criteria or []
+        self.enqueued_at = time.perf_counter()
+        self.done = threading.Event()
+        self.result: Optional[str] = None
+        self.error: Optional[Exception] = None
+
+    @property
+    def batch_key(self) -> tuple:
+        # Бюджет генерации зависит от нагрузки, а в один батч идут только запросы с одинаковым
+        return (self.kind, self.streamer is None, tuple(sorted(self.generation_kwargs.items())))
+
+
+class InferenceScheduler:
+    """
+    Собирает одновременные запросы одного вида (ответ / название) в батч
+    и выполняет их одним вызовом generate(batch) -> тексты по строкам.
+
+    Батчи разбирают до replicas потоков-реплик. Реплики запускаются по мере
+    надобности: новая — только когда все запущенные заняты и can_add_replica()
+    разрешает. configure_thread(slot) вызывается в потоке реплики при старте,
+    on_expired(request) — для запроса, дедлайн которого истёк ещё в очереди.
+    """
+
+    def __init__(self, max_batch_size: int, wait_ms: float, replicas: int,
+                 generate: Callable[[List[GenerationRequest]], List[str]],
+                 can_add_replica: Optional[Callable[[], bool]] = None,
+                 configure_thread: Optional[Callable[[int], None]] = None,
+                 on_expired: Optional[Callable[[GenerationRequest], None]] = None,
+                 name: str = "cosmocat-replica") -> None:
+        self.max_batch_size = max_batch_size
+        self.wait_s = wait_ms / 1000.0
+        self.replicas = replicas
+        self._generate = generate
+        self._can_add_replica = can_add_replica
+        self._configure_thread = configure_thread
+        self._on_expired = on_expired
+        self._name = name
+        self._pending: List[GenerationRequest] = []
+        self._cond = threading.Condition()
+        self._workers: List[threading.Thread] = []
+        self._stats_lock = threading.Lock()
+        self._stats: Dict[int, Dict[str, float]] = {}
+        self._replica_stats: Dict[int, Dict[str, float]] = {}
+        self._busy = 0
+
+    def enqueue(self, item: GenerationRequest) -> GenerationRequest:
+        """Ставит запрос в очередь, не дожидаясь результата."""
+        with self._cond:
+            self._pending.append(item)
+            self._maybe_add_replica()
+            self._cond.notify_all()
+        return item
+
+    def _maybe_add_replica(self) -> None:
+        started = len(self._workers)
+        if started >= self.replicas:
+            return
+        with self._stats_lock:
+            busy = self._busy
+        if started and busy < started:
+            return
+        if started and self._can_add_replica is not None and not self._can_add_replica():
+            return
+        slot = started
+        worker = threading.Thread(target=self._loop, args=(slot,), name=f"{self._name}-{slot}", daemon=True)
+        worker.start()
+        self._workers.append(worker)
+
+    def submit(self, item: GenerationRequest) -> GenerationRequest:
+        """Ставит запрос в очередь и ждёт его выполнения; ошибка генерации пробрасывается."""
+        self.enqueue(item)
+        item.done.wait()
+        if item.error is not None:
+            raise item.error
+        return item
+
+    def queue_depth(self) -> int:
+        with self._cond:
+            return len(self._pending)
+
+    def _take_batch(self) -> List[GenerationRequest]:
+        """
+        Ждёт первый запрос, затем окно wait_ms добирает попутчиков того же вида.
+        Никогда не возвращает пустой батч.
+        """
+        with self._cond:
+            while True:
+                while not self._pending:
+                    self._cond.wait()
+                first = self._pending[0]
+                if first.streamer is not None:
+                    self._pending.pop(0)
+                    return [first]
+                key = first.batch_key
+                deadline = time.perf_counter() + self.wait_s
+                while True:
+                    same_kind = [r for r in self._pending if r.batch_key == key]
+                    remaining = deadline - time.perf_counter()
+                    if len(same_kind) >= self.max_batch_size or remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = same_kind[:self.max_batch_size]
+                if batch:
+                    self._pending = [r for r in self._pending if r not in batch]
+                    return batch
+                # Пока ждали окно, эти запросы забрала другая реплика — ждём следующие
+
+    def _loop(self, slot: int) -> None:
+        if self._configure_thread is not None:
+            self._configure_thread(slot)
+        while True:
+            batch = self._take_batch()
+            with self._stats_lock:
+                self._busy += 1
+            with self._cond:
+                if self._pending:
+                    # Очередь не опустела — возможно, пора запустить ещё одну реплику
+                    self._maybe_add_replica()
+            started = time.perf_counter()
+            try:
+                texts = self._run_batch(batch)
+                for item, text in zip(batch, texts):
+                    item.result = text
+            except Exception as e:
+                for item in batch:
+                    item.error = e
+                    if item.streamer is not None:
+                        # Разблокируем читателя стримера
+                        item.streamer.end()
+            finished = time.perf_counter()
+            for item in batch:
+                item.done.set()
+            self._record(slot, batch, started, finished)
+
+    def _run_batch(self, batch: List[GenerationRequest]) -> List[str]:
+        now = time.monotonic()
+        live = []
+        for item in batch:
+            if item.deadline is not None and now >= item.deadline:
+                # Время вышло ещё в очереди — модель для него не запускаем
+                item.deadline_hit = True
+                if self._on_expired is not None:
+                    self._on_expired(item)
+                if item.streamer is not None:
+                    item.streamer.end()
+            else:
+                live.append(item)
+        texts = dict(zip(map(id, live), self._generate(live))) if live else {}
+        return [texts.get(id(item), "") for item in batch]
+
+    def _record(self, slot: int, batch: List[GenerationRequest], started: float, finished: float) -> None:
+        with self._stats_lock:
+            self._busy -= 1
+            stats = self._stats.setdefault(len(batch), {
+                "batches": 0, "requests": 0, "generate_seconds": 0.0, "latency_seconds": 0.0,
+            })
+            stats["batches"] += 1
+            stats["requests"] += len(batch)
+            stats["generate_seconds"] += finished - started
+            stats["latency_seconds"] += sum(finished - item.enqueued_at for item in batch)
+
+            replica = self._replica_stats.setdefault(slot, {"batches": 0, "requests": 0, "busy_seconds": 0.0})
+            replica["batches"] += 1
+            replica["requests"] += len(batch)
+            replica["busy_seconds"] += finished - started
+
+    def stats(self) -> Dict[str, Any]:
+        """Пропускная способность и задержка в разрезе размера батча и реплик."""
+        with self._stats_lock:
+            by_size = {}
+            for size, stats in sorted(self._stats.items()):
+                by_size[str(size)] = {
+                    "batches": int(stats["batches"]),
+                    "requests": int(stats["requests"]),
+                    "avg_generate_ms": round(1000 * stats["generate_seconds"] / stats["batches"], 1) if stats["batches"] else None,
+                    "avg_latency_ms": round(1000 * stats["latency_seconds"] / stats["requests"], 1) if stats["requests"] else None,
+                    "throughput_rps": round(stats["requests"] / stats["generate_seconds"], 3) if stats["generate_seconds"] else None,
+                }
+            replicas = {
+                str(slot): {
+                    "batches": int(stats["batches"]),
+                    "requests": int(stats["requests"]),
+                    "busy_seconds": round(stats["busy_seconds"], 2),
+                }
+                for slot, stats in sorted(self._replica_stats.items())
+            }
+            busy = self._busy
+        return {
+            "max_batch_size": self.max_batch_size,
+            "wait_ms": self.wait_s * 1000.0,
+            "queue_depth": self.queue_depth(),
+            "replicas": self.replicas,
+            "replicas_started": len(self._workers),
+            "busy_replicas": busy,
+            "by_batch_size": by_size,
+            "by_replica": replicas,
+        }
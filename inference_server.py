@@ -0,0 +1,290 @@
+"""Inference server: one process holds the model, web workers talk to it over a local socket."""
+
+from __future__ import annotations
+from typing import List, Dict, Optional, Iterator, Any, Tuple, Union
+from multiprocessing.connection import Listener, Client, Connection
+import multiprocessing
+import os
+import random
+import secrets
+import sys
+import threading
+import time
+
+import ai_core
+
+# Адрес сервера: путь к Unix-сокету или "host:port" (например, на Windows).
+# По умолчанию сокет лежит в личной папке пользователя ($XDG_RUNTIME_DIR) или рядом
+# с приложением — не в общем /tmp, где имя может заранее занять другой пользователь
+DEFAULT_ADDRESS = os.path.join(
+    os.environ.get("XDG_RUNTIME_DIR") or os.path.dirname(os.path.abspath(__file__)), "cosmocats-inference.sock"
+)
+# Сколько секунд клиент ждёт ответа сервера
+CLIENT_TIMEOUT = float(os.environ.get("INFERENCE_TIMEOUT", "120"))
+# Как часто супервизор проверяет, что сервер отвечает
+HEALTH_INTERVAL = float(os.environ.get("INFERENCE_HEALTH_INTERVAL", "10"))
+# После скольких неудачных проверок подряд сервер перезапускается
+HEALTH_FAILURES = int(os.environ.get("INFERENCE_HEALTH_FAILURES", "3"))
+
+# Общий ключ сервера и веб-воркеров, если не задан INFERENCE_AUTHKEY: создаётся при
+# первом запуске сервера, читать его может только владелец
+AUTHKEY_FILE = os.environ.get(
+    "INFERENCE_AUTHKEY_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".inference_authkey")
+)
+# Слушать не-loopback адрес можно только явно (и только со своим INFERENCE_AUTHKEY)
+ALLOW_REMOTE = os.environ.get("INFERENCE_ALLOW_REMOTE", "0") == "1"
+_LOOPBACK_HOSTS = {"127.0.0.1", "localhost", "::1"}
+
+Address = Union[str, Tuple[str, int]]
+
+
+def get_address() -> Address:
+    raw = os.environ.get("INFERENCE_ADDRESS", DEFAULT_ADDRESS)
+    if ":" in raw and not raw.startswith("/") and not os.path.splitdrive(raw)[0]:
+        host, port = raw.rsplit(":", 1)
+        return (host, int(port))
+    return raw
+
+
+def _authkey(create: bool = False) -> bytes:
+    """
+    Ключ рукопожатия: INFERENCE_AUTHKEY или случайный ключ из AUTHKEY_FILE.
+    Соединение принимает pickle, поэтому ключ должен знать только сам сервер
+    и его веб-воркеры. Файл создаёт сервер (create=True), клиенты только читают.
+    """
+    key = os.environ.get("INFERENCE_AUTHKEY")
+    if key:
+        return key.encode("utf-8")
+    if create:
+        try:
+            fd = os.open(AUTHKEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            pass
+        else:
+            with os.fdopen(fd, "w") as f:
+                f.write(secrets.token_hex(32))
+    if os.name == "posix" and os.stat(AUTHKEY_FILE).st_mode & 0o077:
+        raise RuntimeError(f"ключ {AUTHKEY_FILE} доступен другим пользователям, выполните chmod 600")
+    with open(AUTHKEY_FILE) as f:
+        key = f.read().strip()
+    if not key:
+        raise RuntimeError(f"ключ {AUTHKEY_FILE} пуст")
+    return key.encode("utf-8")
+
+
+def _check_address(address: Address) -> None:
+    """Не даём открыть сервер в сеть случайно: по TCP — только loopback, если не разрешено явно"""
+    if isinstance(address, str) or address[0] in _LOOPBACK_HOSTS:
+        return
+    if not ALLOW_REMOTE:
+        raise RuntimeError(
+            f"адрес {address[0]} доступен не только локально; задайте INFERENCE_ALLOW_REMOTE=1, если это нужно"
+        )
+    if not os.environ.get("INFERENCE_AUTHKEY"):
+        raise RuntimeError("для сетевого адреса нужен свой ключ в INFERENCE_AUTHKEY")
+
+
+# === Сервер ===
+
+# Часы time.monotonic() у процессов разные, поэтому дедлайн передаётся как остаток в секундах
+
+def _pack_deadline(messages: List[Dict[str, str]], deadline: Optional[float]) -> tuple:
+    return messages, None if deadline is None else deadline - time.monotonic()
+
+
+def _unpack_deadline(payload: tuple) -> tuple:
+    messages, remaining = payload
+    return messages, None if remaining is None else time.monotonic() + remaining
+
+
+def _handle(conn: Connection) -> None:
+    """Обслуживает одно соединение: один запрос — один ответ (или поток событий)."""
+    try:
+        op, payload = conn.recv()
+        if op == "reply":
+            conn.send(("ok", ai_core.generate_reply(*_unpack_deadline(payload))))
+        elif op == "title":
+            conn.send(("ok", ai_core.generate_chat_title(payload)))
+        elif op == "stream":
+            events = ai_core.stream_reply(*_unpack_deadline(payload))
+            try:
+                for event in events:
+                    conn.send(("event", event))
+            finally:
+                # Клиент ушёл или поток закончился — останавливаем генерацию
+                events.close()
+            conn.send(("end", None))
+        elif op == "health":
+            conn.send(("ok", dict(ai_core.model_status(), pid=os.getpid())))
+        elif op == "metrics":
+            conn.send(("ok", ai_core.get_metrics()))
+        else:
+            conn.send(("error", f"unknown operation: {op}"))
+    except (EOFError, OSError):
+        pass
+    except Exception as e:
+        print(f"❌ Ошибка сервера инференса: {e}")
+        try:
+            conn.send(("error", str(e)))
+        except Exception:
+            pass
+    finally:
+        conn.close()
+
+
+def serve(address: Optional[Address] = None) -> None:
+    """Запускает сервер инференса в текущем процессе (блокирующий вызов)."""
+    # Внутри сервера ai_core всегда работает с моделью напрямую
+    os.environ["INFERENCE_MODE"] = "local"
+    address = address or get_address()
+    _check_address(address)
+    if isinstance(address, str) and os.path.exists(address):
+        os.unlink(address)
+
+    listener = Listener(address, authkey=_authkey(create=True))
+    if isinstance(address, str):
+        os.chmod(address, 0o600)
+    print(f"✅ Сервер инференса слушает {address} (pid {os.getpid()})")
+
+    # Модель грузится в фоне, чтобы проверки здоровья отвечали сразу
+    ai_core.preload_async()
+
+    try:
+        while True:
+            try:
+                conn = listener.accept()
+            except (OSError, EOFError) as e:
+                # Например, клиент с неверным ключом
+                print(f"⚠️ Отклонено соединение с сервером инференса: {e}")
+                continue
+            threading.Thread(target=_handle, args=(conn,), name="cosmocat-inference-conn", daemon=True).start()
+    finally:
+        listener.close()
+
+
+def supervise(address: Optional[Address] = None) -> None:
+    """
+    Держит процесс сервера инференса живым: перезапускает его, если он упал
+    или перестал отвечать на проверки здоровья.
+    """
+    address = address or get_address()
+    # Ошибки настройки видны сразу, а не как бесконечные перезапуски
+    _check_address(address)
+    _authkey(create=True)
+    ctx = multiprocessing.get_context("spawn")
+    backoff = 1.0
+    while True:
+        started = time.monotonic()
+        proc = ctx.Process(target=serve, args=(address,), name="cosmocat-inference", daemon=True)
+        proc.start()
+        failures = 0
+        while proc.is_alive():
+            proc.join(HEALTH_INTERVAL)
+            if not proc.is_alive():
+                break
+            if health(address, timeout=HEALTH_INTERVAL) is None:
+                failures += 1
+                print(f"⚠️ Сервер инференса не отвечает ({failures}/{HEALTH_FAILURES})")
+                if failures >= HEALTH_FAILURES:
+                    proc.terminate()
+                    proc.join(5)
+                    if proc.is_alive():
+                        proc.kill()
+                        proc.join()
+            else:
+                failures = 0
+
+        print(f"❌ Сервер инференса завершился (код {proc.exitcode}), перезапуск через {backoff:.0f} с")
+        time.sleep(backoff)
+        # Долго проработавший процесс сбрасывает задержку, частые падения её наращивают
+        backoff = 1.0 if time.monotonic() - started > 60 else min(backoff * 2, 30.0)
+
+
+# === Клиент ===
+
+def _connect(address: Optional[Address] = None) -> Connection:
+    return Client(address or get_address(), authkey=_authkey())
+
+
+def _call(op: str, payload: Any = None, timeout: float = CLIENT_TIMEOUT, address: Optional[Address] = None) -> Any:
+    with _connect(address) as conn:
+        conn.send((op, payload))
+        if not conn.poll(timeout):
+            raise TimeoutError(f"сервер инференса не ответил за {timeout:.0f} с")
+        status, result = conn.recv()
+    if status != "ok":
+        raise RuntimeError(result)
+    return result
+
+
+def health(address: Optional[Address] = None, timeout: float = 5.0) -> Optional[Dict[str, Any]]:
+    """Проверка здоровья сервера: dict с pid и состоянием загрузки модели или None, если он недоступен."""
+    try:
+        return _call("health", timeout=timeout, address=address)
+    except Exception:
+        return None
+
+
+def generate_reply(messages: List[Dict[str, str]], deadline: Optional[float] = None) -> str:
+    """Клиент к ai_core.generate_reply на сервере инференса."""
+    try:
+        return _call("reply", _pack_deadline(messages, deadline))
+    except Exception as e:
+        print(f"❌ Сервер инференса недоступен: {e}")
+        return random.choice(ai_core._REPLY_FALLBACKS)
+
+
+def generate_chat_title(first_message: str) -> str:
+    """Клиент к ai_core.generate_chat_title на сервере инференса."""
+    try:
+        return _call("title", first_message)
+    except Exception as e:
+        print(f"❌ Сервер инференса недоступен: {e}")
+        return random.choice(ai_core._TITLE_FALLBACKS)
+
+
+def stream_reply(messages: List[Dict[str, str]], deadline: Optional[float] = None) -> Iterator[Dict[str, str]]:
+    """Клиент к ai_core.stream_reply: пересылает события с сервера по мере генерации."""
+    try:
+        conn = _connect()
+    except Exception as e:
+        print(f"❌ Сервер инференса недоступен: {e}")
+        reply = random.choice(ai_core._REPLY_FALLBACKS)
+        yield {"type": "token", "text": reply}
+        yield {"type": "done", "reply": reply}
+        return
+
+    # При закрытии генератора соединение рвётся, и сервер останавливает генерацию
+    with conn:
+        conn.send(("stream", _pack_deadline(messages, deadline)))
+        while True:
+            if not conn.poll(ai_core.STREAM_TOKEN_TIMEOUT):
+                print("❌ Сервер инференса перестал присылать токены")
+                yield {"type": "done", "reply": "Мяу! Что-то пошло не так... Попробуй ещё раз! 😺"}
+                return
+            status, event = conn.recv()
+            if status == "event":
+                yield event
+                if event.get("type") == "done":
+                    return
+            else:
+                if status == "error":
+                    print(f"❌ Ошибка сервера инференса: {event}")
+                    yield {"type": "done", "reply": "Мяу! Что-то пошло не так... Попробуй ещё раз! 😺"}
+                return
+
+
+def get_metrics() -> Dict[str, Any]:
+    try:
+        return _call("metrics", timeout=5.0)
+    except Exception as e:
+        return {"error": str(e)}
+
+
+if __name__ == "__main__":
+    # python inference_server.py          — сервер с автоперезапуском
+    # python inference_server.py --once   — один процесс без супервизора
+    if "--once" in sys.argv[1:]:
+        serve()
+    else:
+        supervise()
@@ -0,0 +1,246 @@
+from __future__ import annotations
+from typing import Dict, List, Optional, Any
+import os
+import threading
+import time
+import uuid
+
+import ai_core
+import chat_manager
+from admission import AdmissionController, QueueFull
+from db_manager import get_session, ReplyJob
+
+# Сколько ответов генерируется одновременно (отдельно от потоков веб-сервера)
+REPLY_WORKERS = int(os.environ.get("REPLY_WORKERS", "2"))
+# Сколько секунд готовый ответ можно забрать по job_id
+JOB_TTL = float(os.environ.get("JOB_TTL", "300"))
+# Сколько ходов может ждать в очереди всего и от одного пользователя
+ADMISSION_QUEUE_SIZE = int(os.environ.get("ADMISSION_QUEUE_SIZE", "32"))
+ADMISSION_USER_QUEUE = int(os.environ.get("ADMISSION_USER_QUEUE", "2"))
+# Сколько ответов одного пользователя генерируется одновременно
+ADMISSION_PER_USER = int(os.environ.get("ADMISSION_PER_USER", "1"))
+# Максимальное время одного long-poll запроса
+MAX_POLL_WAIT = 30.0
+# Как часто текст генерации пишется в общую таблицу и как часто её опрашивает
+# воркер, которому задача не принадлежит (при нескольких процессах веб-сервера)
+JOB_FLUSH_INTERVAL = float(os.environ.get("JOB_FLUSH_INTERVAL", "0.25"))
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", "0.25"))
+
+_ERROR_REPLY = "Мяу... Похоже, мои двигатели перегрелись. Попробуйте ещё раз."
+
+_admission = AdmissionController(
+    REPLY_WORKERS, ADMISSION_QUEUE_SIZE, ADMISSION_PER_USER, ADMISSION_USER_QUEUE, name="cosmocat-reply",
+)
+# Ходы, ждущие в очереди, — тоже нагрузка для адаптивного бюджета генерации
+ai_core.set_load_probe(_admission.queue_depth)
+# Задачи, которые выполняет этот процесс; задачи других процессов читаются из reply_jobs
+_jobs: Dict[str, "_ReplyJob"] = {}
+_jobs_lock = threading.Lock()
+
+
+class _ReplyJob:
+    """Генерация одного ответа ассистента: статус и текст по мере готовности."""
+
+    def __init__(self, chat_id: str, user_id: int) -> None:
+        self.job_id = uuid.uuid4().hex
+        self.chat_id = chat_id
+        self.user_id = user_id
+        # queued -> running -> done
+        self.status = "queued"
+        self.text = ""
+        self.reply: Optional[str] = None
+        self.finished_at: Optional[float] = None
+        # Дедлайн ответа отсчитывается с момента, когда ход принят, — вместе с ожиданием в очереди
+        self.deadline = ai_core.reply_deadline()
+        self.changed = threading.Condition()
+        # Клиент ушёл — генерацию можно остановить
+        self.cancelled = threading.Event()
+        self.saved_at = 0.0
+
+    def update(self, **fields: Any) -> None:
+        with self.changed:
+            for name, value in fields.items():
+                setattr(self, name, value)
+            self.changed.notify_all()
+        # Смена статуса пишется сразу, новые токены — не чаще JOB_FLUSH_INTERVAL
+        _save(self, force="status" in fields)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.job_id,
+            "chat_id": self.chat_id,
+            "status": self.status,
+            "text": self.text,
+            "reply": self.reply,
+        }
+
+
+def _save(job: _ReplyJob, force: bool = False) -> None:
+    """Пишет состояние задачи в reply_jobs и заодно узнаёт, не отменил ли её другой воркер"""
+    now = time.monotonic()
+    if not force and now - job.saved_at < JOB_FLUSH_INTERVAL:
+        return
+    job.saved_at = now
+    with job.changed:
+        state = job.snapshot()
+    try:
+        with get_session() as session:
+            row = session.get(ReplyJob, job.job_id)
+            if row is None:
+                row = ReplyJob(job_id=job.job_id, chat_id=job.chat_id, user_id=job.user_id)
+                session.add(row)
+            row.status = state["status"]
+            row.text = state["text"]
+            row.reply = state["reply"]
+            row.finished_at = time.time() if state["status"] == "done" else None
+            if row.cancel_requested:
+                job.cancelled.set()
+    except Exception as e:
+        print(f"❌ Ошибка сохранения задачи {job.job_id}: {e}")
+
+
+def _stream(job: _ReplyJob, history: List[Dict[str, str]]) -> Optional[str]:
+    """Стримит ответ модели в job.text; None — генерация отменена или не дала ответа"""
+    reply = None
+    # Если дедлайн истёк ещё в очереди, ai_core сразу отдаёт заглушку
+    events = ai_core.stream_reply(history, deadline=job.deadline)
+    try:
+        for event in events:
+            if job.cancelled.is_set():
+                break
+            if event["type"] == "token":
+                job.update(text=job.text + event["text"])
+            elif event["type"] == "done":
+                reply = event["reply"]
+    finally:
+        # Закрываем генератор, чтобы остановить модель при отмене
+        events.close()
+    return reply
+
+
+def _run(job: _ReplyJob, message: str) -> None:
+    job.update(status="running")
+    turn = None
+    reply = None
+    try:
+        # Сообщение сохраняется, когда подошла очередь: отклонённый ход не попадает в историю.
+        # Проверка владельца, вставка и окно контекста — одна транзакция
+        turn = chat_manager.begin_turn(job.chat_id, job.user_id, message)
+        if turn is None:
+            print(f"⚠️ Чат {job.chat_id} не найден")
+        else:
+            reply = _stream(job, turn[1])
+    except Exception as e:
+        print(f"❌ Ошибка генерации ответа: {e}")
+    if job.cancelled.is_set():
+        job.update(status="done", reply=_ERROR_REPLY, finished_at=time.monotonic())
+        return
+    if reply is None:
+        reply = _ERROR_REPLY
+    if turn is not None:
+        try:
+            chat_manager.finish_turn(job.chat_id, turn[0], reply)
+        except Exception as e:
+            print(f"❌ Ошибка сохранения ответа: {e}")
+    job.update(status="done", text=reply, reply=reply, finished_at=time.monotonic())
+
+
+def _prune_jobs() -> None:
+    """Забыть готовые задачи, которые никто не забрал за JOB_TTL"""
+    now = time.monotonic()
+    with _jobs_lock:
+        expired = [job_id for job_id, job in _jobs.items()
+                   if job.finished_at is not None and now - job.finished_at > JOB_TTL]
+        for job_id in expired:
+            del _jobs[job_id]
+    with get_session() as session:
+        session.query(ReplyJob).filter(ReplyJob.finished_at < time.time() - JOB_TTL).delete(synchronize_session=False)
+
+
+def submit_turn(chat_id: str, user_id: int, message: str) -> str:
+    """
+    Ставит ход (сообщение пользователя и генерацию ответа) в очередь.
+    Возвращает job_id, по которому ответ забирается через wait_job.
+    Бросает QueueFull, если очередь заполнена.
+    """
+    _prune_jobs()
+    job = _ReplyJob(chat_id, user_id)
+    with _jobs_lock:
+        _jobs[job.job_id] = job
+    # Строка появляется до ответа клиенту: опрос может прийти в любой воркер
+    _save(job, force=True)
+    try:
+        _admission.submit(user_id, _run, job, message)
+    except QueueFull:
+        with _jobs_lock:
+            del _jobs[job.job_id]
+        with get_session() as session:
+            session.query(ReplyJob).filter(ReplyJob.job_id == job.job_id).delete(synchronize_session=False)
+        raise
+    return job.job_id
+
+
+def wait_job(job_id: str, user_id: int, offset: int = 0, timeout: float = 0.0) -> Optional[Dict[str, Any]]:
+    """
+    Состояние задачи. Ждёт до timeout секунд, пока не появится текст длиннее
+    offset символов или ответ не будет готов. None — задачи нет или она чужая.
+    """
+    deadline = time.monotonic() + min(max(timeout, 0.0), MAX_POLL_WAIT)
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+    if job is None:
+        return _wait_shared(job_id, user_id, offset, deadline)
+    if job.user_id != user_id:
+        return None
+
+    with job.changed:
+        while job.status != "done" and len(job.text) <= offset:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            job.changed.wait(remaining)
+        return job.snapshot()
+
+
+def _wait_shared(job_id: str, user_id: int, offset: int, deadline: float) -> Optional[Dict[str, Any]]:
+    """wait_job для задачи другого процесса: опрашивает reply_jobs до deadline"""
+    while True:
+        with get_session() as session:
+            row = session.get(ReplyJob, job_id)
+            if row is None or row.user_id != user_id:
+                return None
+            state = {
+                "job_id": row.job_id,
+                "chat_id": row.chat_id,
+                "status": row.status,
+                "text": row.text,
+                "reply": row.reply,
+            }
+        if state["status"] == "done" or len(state["text"]) > offset or time.monotonic() >= deadline:
+            return state
+        time.sleep(min(JOB_POLL_INTERVAL, max(0.0, deadline - time.monotonic())))
+
+
+def cancel_job(job_id: str, user_id: int) -> None:
+    """Остановить генерацию, ответ которой больше никто не ждёт"""
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+    if job is not None:
+        if job.user_id == user_id and job.status != "done":
+            job.cancelled.set()
+        return
+    # Задачу выполняет другой процесс: он увидит флаг при следующей записи
+    with get_session() as session:
+        session.query(ReplyJob).filter(
+            ReplyJob.job_id == job_id, ReplyJob.user_id == user_id, ReplyJob.status != "done",
+        ).update({"cancel_requested": True}, synchronize_session=False)
+
+
+def stats() -> Dict[str, Any]:
+    """Сколько задач этого процесса в очереди, выполняется и готово"""
+    with _jobs_lock:
+        jobs = list(_jobs.values())
+    counts = {"queued": 0, "running": 0, "done": 0}
+    for job in jobs:
+        counts[job.status] += 1
+    return dict(counts, admission=_admission.stats())
@@ -0,0 +1,126 @@
+"""Model lifecycle: in-flight tracking, idle unload and the process memory budget."""
+
+from __future__ import annotations
+from typing import Callable, Dict, Any
+from contextlib import contextmanager
+import os
+import sys
+import threading
+import time
+
+
+def rss_mb() -> float:
+    """Текущий RSS процесса в МБ (на не-Linux — пиковый)."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss в килобайтах на Linux и в байтах на macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def dir_size_mb(path: str) -> float:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total / (1024 * 1024)
+
+
+class ModelLifecycle:
+    """
+    Следит, пользуется ли кто-нибудь моделью: пока запрос внутри in_use(),
+    она не выгружается. Фоновый поток вызывает unload, когда модель простаивает
+    дольше idle_unload секунд (0 — никогда). memory_allows проверяет, что RSS
+    процесса вместе с новой памятью укладывается в memory_budget_mb (0 — без предела).
+    """
+
+    def __init__(self, idle_unload: float, memory_budget_mb: float, unload: Callable[[], bool],
+                 name: str = "cosmocat-idle-unload") -> None:
+        self.idle_unload = idle_unload
+        self.memory_budget_mb = memory_budget_mb
+        # Освобождает модель; False — выгружать нечего или она сейчас грузится
+        self._unload = unload
+        self._name = name
+        # Сколько запросов сейчас пользуются моделью и когда она использовалась в последний раз
+        self._cond = threading.Condition()
+        self._inflight = 0
+        self._last_used = time.monotonic()
+        self._reaper_started = False
+        self._stats: Dict[str, Any] = {
+            "loads": 0, "unloads": 0, "refused_loads": 0, "refused_replicas": 0,
+            "last_load_seconds": None, "last_unload_at": None,
+        }
+
+    def memory_allows(self, extra_mb: float) -> bool:
+        """Поместится ли в бюджет ещё extra_mb мегабайт."""
+        return self.memory_budget_mb <= 0 or rss_mb() + extra_mb <= self.memory_budget_mb
+
+    def count(self, event: str) -> None:
+        with self._cond:
+            self._stats[event] += 1
+
+    def loaded(self, seconds: float) -> None:
+        """Модель загружена: отсчёт простоя начинается заново."""
+        with self._cond:
+            self._stats["loads"] += 1
+            self._stats["last_load_seconds"] = seconds
+            self._last_used = time.monotonic()
+        self._start_reaper()
+
+    @contextmanager
+    def in_use(self):
+        """Пока запрос внутри блока, модель не выгружается по простою."""
+        with self._cond:
+            self._inflight += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._inflight -= 1
+                self._last_used = time.monotonic()
+
+    def unload_if_idle(self) -> bool:
+        """Выгружает модель, если ею никто не пользуется дольше idle_unload секунд."""
+        with self._cond:
+            if self._inflight or time.monotonic() - self._last_used < self.idle_unload:
+                return False
+            # Под блокировкой: пока идёт выгрузка, новый запрос не войдёт в in_use()
+            started = time.perf_counter()
+            if not self._unload():
+                return False
+            self._stats["unloads"] += 1
+            self._stats["last_unload_at"] = time.time()
+            print(f"💤 Модель выгружена после {self.idle_unload:.0f} с простоя ({time.perf_counter() - started:.2f} с)")
+            return True
+
+    def _reaper(self) -> None:
+        while True:
+            time.sleep(max(1.0, min(self.idle_unload / 4, 30.0)))
+            self.unload_if_idle()
+
+    def _start_reaper(self) -> None:
+        with self._cond:
+            if self.idle_unload <= 0 or self._reaper_started:
+                return
+            self._reaper_started = True
+        threading.Thread(target=self._reaper, name=self._name, daemon=True).start()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return dict(
+                self._stats,
+                idle_unload_seconds=self.idle_unload,
+                memory_budget_mb=self.memory_budget_mb,
+                rss_mb=round(rss_mb(), 1),
+                idle_seconds=round(time.monotonic() - self._last_used, 1),
+                inflight=self._inflight,
+            )
@@ -63,12 +63,18 @@ def upload_avatar(user_id: int, image_bytes: bytes) -> bool:
         user = session.get(db_manager.User, user_id)
         if user is None:
             return False
-        user.avatar_blob = prepared
+        db_manager.store_user_avatar(session, user, prepared)
         return True
 
+def get_user_avatar_hash(user_id: int) -> Optional[str]:
+    """Хэш аватара без загрузки самой картинки"""
+    with db_manager.get_session() as session:
+        return session.query(db_manager.User.avatar_hash).filter(db_manager.User.id == user_id).scalar()
+
 def get_user_avatar(user_id: int) -> Optional[bytes]:
     with db_manager.get_session() as session:
-        user = session.get(db_manager.User, user_id)
-        if user is None or not user.avatar_blob:
-            return None
-        return user.avatar_blob
\ No newline at end of file
+        return (
+            session.query(db_manager.UserAvatar.avatar_blob)
+            .filter(db_manager.UserAvatar.user_id == user_id)
+            .scalar()
+        )
\ No newline at end of file
@@ -0,0 +1,103 @@
+"""Cache of model replies to short, common messages ("Привет!", "Как дела?")."""
+
+from __future__ import annotations
+from typing import Dict, List, Optional, Any
+from collections import OrderedDict
+import random
+import re
+import threading
+import time
+
+
+def normalize_for_cache(text: str) -> str:
+    """Регистр, ё, пунктуация и эмодзи не различаются: "Привет!!" и "привет" — один ключ."""
+    text = text.lower().replace("ё", "е")
+    return " ".join(re.sub(r"[^\w\s]", " ", text).split())
+
+
+class ReplyCache:
+    """
+    LRU-кэш с TTL: ключ — отпечаток контекста, значение — пул из нескольких
+    разных ответов модели. Пока пул не заполнен, модель продолжает генерировать
+    и пополнять его; после этого ответ выбирается из пула случайно.
+
+    Кэшируются только короткие разговоры: не больше max_messages сообщений
+    по max_chars символов, последнее — от пользователя.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, pool_size: int,
+                 max_messages: int, max_chars: int) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.pool_size = max(1, pool_size)
+        self.max_messages = max_messages
+        self.max_chars = max_chars
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._stats = {"hits": 0, "misses": 0, "fills": 0, "evictions": 0, "expirations": 0}
+
+    def key(self, messages: List[Dict[str, str]]) -> Optional[str]:
+        """Отпечаток недавнего контекста или None, если разговор слишком длинный для кэша."""
+        if not messages or len(messages) > self.max_messages or messages[-1].get("role") != "user":
+            return None
+        parts = []
+        for m in messages:
+            content = m.get("content", "")
+            if len(content) > self.max_chars:
+                return None
+            parts.append(f"{m.get('role', 'user')}:{normalize_for_cache(content)}")
+        return "\n".join(parts)
+
+    @staticmethod
+    def _entry_bytes(key: str, replies: List[str]) -> int:
+        return len(key.encode("utf-8")) + sum(len(r.encode("utf-8")) for r in replies)
+
+    def _drop(self, key: str) -> None:
+        entry = self._entries.pop(key)
+        self._bytes -= self._entry_bytes(key, entry["replies"])
+
+    def get(self, key: str) -> Optional[str]:
+        """Ответ из заполненного пула или None — тогда нужна генерация."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry["created"] > self.ttl:
+                self._drop(key)
+                self._stats["expirations"] += 1
+                entry = None
+            if entry is None or len(entry["replies"]) < self.pool_size:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return random.choice(entry["replies"])
+
+    def add(self, key: str, reply: str) -> None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = {"created": time.monotonic(), "replies": []}
+                self._bytes += self._entry_bytes(key, [])
+            self._entries.move_to_end(key)
+            if reply in entry["replies"] or len(entry["replies"]) >= self.pool_size:
+                return
+            entry["replies"].append(reply)
+            self._bytes += len(reply.encode("utf-8"))
+            self._stats["fills"] += 1
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+                self._stats["evictions"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return dict(
+                self._stats,
+                entries=len(self._entries),
+                max_entries=self.max_entries,
+                full_pools=sum(1 for e in self._entries.values() if len(e["replies"]) >= self.pool_size),
+                pool_size=self.pool_size,
+                ttl_seconds=self.ttl,
+                bytes=self._bytes,
+                hit_rate=round(self._stats["hits"] / lookups, 3) if lookups else None,
+            )